@@ -0,0 +1,84 @@
+"""
+排序效能比較：舊的逐筆 haversine + sort vs rank_places（逐筆 / numpy 向量化）。
+（legacy 不算偏好分數，score 模式的倍數只是參考。）
+
+用法（在 functions/ 下）：
+    python bench/bench_ranking.py --sizes 20,100,500,2000 --repeat 200
+"""
+import argparse, os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+USER_LAT, USER_LNG = 22.9970, 120.2127   # 台南
+NAMES = ["牛肉麵", "拉麵", "滷味", "燒臘", "咖哩飯", "早午餐", "咖啡", "便當", "火鍋", "小吃"]
+PREFS = {"拉麵": 12, "牛肉麵": 7, "咖哩飯": 3, "火鍋": 1}
+
+def make_pool(n: int, seed: int = 0) -> list[dict]:
+    rnd = random.Random(seed)
+    pool = []
+    for i in range(n):
+        pool.append({
+            "name": f"{rnd.choice(NAMES)} {i}號店",
+            "placeId": f"pid{i}",
+            "lat": USER_LAT + rnd.uniform(-0.02, 0.02),
+            "lng": USER_LNG + rnd.uniform(-0.02, 0.02),
+            "rating": round(rnd.uniform(3.0, 5.0), 1) if rnd.random() > 0.1 else None,
+            "total": rnd.randint(0, 3000),
+        })
+    return pool
+
+def legacy(items: list[dict]) -> list[dict]:
+    """改版前 search_nearby_tiered 的做法：每筆算一次 haversine，再依 (距離, -評分) 排序"""
+    for it in items:
+        it["distKm"] = round(main._haversine_km(USER_LAT, USER_LNG, it["lat"], it["lng"]), 2)
+    return sorted(items, key=lambda x: (x["distKm"], -(x.get("rating") or 0)))
+
+def bench(fn, pool: list[dict], repeat: int) -> float:
+    fn(pool)  # warm-up
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn(pool)
+    return (time.perf_counter() - t0) / repeat
+
+def main_() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="20,100,500,2000")
+    ap.add_argument("--repeat", type=int, default=200)
+    args = ap.parse_args()
+
+    # 不讀 Firestore：settings 直接用預設值
+    main._store_settings({}, ttl_sec=10**9)
+    np = main._numpy()
+    dist_cfg = main._ranking_config({"mode": "distance"})
+    score_cfg = main._ranking_config({"mode": "score"})
+
+    cases = [
+        ("legacy loop", legacy),
+        ("scalar distance", lambda p: main._rank_scalar(p, USER_LAT, USER_LNG, PREFS, dist_cfg)),
+        ("scalar score", lambda p: main._rank_scalar(p, USER_LAT, USER_LNG, PREFS, score_cfg)),
+    ]
+    if np is not None:
+        cases += [
+            ("numpy distance", lambda p: main._rank_vectorized(np, p, USER_LAT, USER_LNG, PREFS, dist_cfg)),
+            ("numpy score", lambda p: main._rank_vectorized(np, p, USER_LAT, USER_LNG, PREFS, score_cfg)),
+        ]
+    else:
+        print("numpy 未安裝，只跑逐筆版本")
+    # 實際入口：候選池小於 RANK_NUMPY_MIN 時自動走逐筆版本
+    cases += [
+        ("rank_places dist", lambda p: main.rank_places(p, USER_LAT, USER_LNG, PREFS, {"mode": "distance"})),
+        ("rank_places score", lambda p: main.rank_places(p, USER_LAT, USER_LNG, PREFS, {"mode": "score"})),
+    ]
+
+    print(f"{'size':>6}  {'case':<17} {'ms/call':>9} {'items/s':>12} {'vs legacy':>9}")
+    for n in (int(x) for x in args.sizes.split(",")):
+        pool = make_pool(n)
+        base = None
+        for label, fn in cases:
+            sec = bench(fn, pool, args.repeat)
+            base = base or sec
+            print(f"{n:>6}  {label:<17} {sec * 1e3:>9.3f} {n / sec:>12,.0f} {base / sec:>8.2f}x")
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,130 @@
+"""
+冷啟動量測：每一輪開一個全新的 Python process，量
+  - import main 的時間（含 firebase_functions / Admin SDK 等相依套件）
+  - import 後已載入哪些重量級 module
+  - 第一個 webhook request（follow）、第一次查 Places（location）與之後各 request 的延遲
+LINE / Places 打到本機 stand-in server，Firestore 用記憶體版。
+
+用法（在 functions/ 下）：
+    python bench/bench_startup.py --runs 7
+    python bench/bench_startup.py --runs 7 --ref HEAD~1     # 和舊版 main.py 比較
+
+--ref 的 main.py 若還不支援 LINE_API_BASE，只量 import（避免打到真正的 LINE / Places）。
+"""
+import argparse, json, os, statistics, subprocess, sys, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from standin import StandIn  # noqa: E402
+
+HEAVY = ["httpx._client", "h2", "numpy", "firebase_admin.auth", "google.cloud.firestore_v1", "asyncio"]
+
+# 子 process 跑的程式：先把 firestore.client 換成記憶體版，再 import main
+CHILD = r"""
+import json, os, sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, os.environ["BENCH_DIR"])
+import firebase_admin.firestore as _fa_fs
+from fake_firestore import FakeFirestore
+_fake = FakeFirestore()
+_fa_fs.client = lambda app=None: _fake
+import main
+import_ms = (time.perf_counter() - t0) * 1000
+out = {"import_ms": import_ms, "loaded": [m for m in json.loads(os.environ["BENCH_HEAVY"]) if m in sys.modules]}
+
+if os.environ.get("BENCH_REQUESTS") == "1":
+    from bench_webhook import make_request, scenario
+    _fake.collection("settings").document("maps").set({"enabled": True})
+    lat = []
+    for ev in scenario("Ustartup", 0):
+        req = make_request({"destination": "bench", "events": [ev]})
+        t = time.perf_counter()
+        resp = main.line(req)
+        lat.append((time.perf_counter() - t) * 1000)
+        assert resp.status_code == 200, resp.status_code
+    out["requests_ms"] = lat
+    out["loaded_after"] = [m for m in json.loads(os.environ["BENCH_HEAVY"]) if m in sys.modules]
+print("BENCH_RESULT " + json.dumps(out))
+"""
+
+
+def run_once(main_dir: str, env: dict) -> dict:
+    p = subprocess.run([sys.executable, "-c", CHILD], cwd=main_dir, env=env,
+                       capture_output=True, text=True, timeout=120)
+    for line in p.stdout.splitlines():
+        if line.startswith("BENCH_RESULT "):
+            return json.loads(line.split(" ", 1)[1])
+    raise RuntimeError(f"child failed (exit {p.returncode}):\n{p.stderr[-2000:]}")
+
+
+def measure(main_dir: str, runs: int, env: dict) -> dict:
+    results = [run_once(main_dir, env) for _ in range(runs)]
+    out = {
+        "import_ms": statistics.median(r["import_ms"] for r in results),
+        "loaded": results[-1]["loaded"],
+    }
+    if "requests_ms" in results[0]:
+        per_req = list(zip(*(r["requests_ms"] for r in results)))
+        out["requests_ms"] = [statistics.median(x) for x in per_req]
+        out["loaded_after"] = results[-1]["loaded_after"]
+    return out
+
+
+def source_at(ref: str) -> str:
+    """把 ref 版本的 main.py 放到暫存目錄，回傳目錄路徑"""
+    src = subprocess.run(["git", "show", f"{ref}:functions/main.py"], cwd=FUNCTIONS_DIR,
+                         capture_output=True, text=True, check=True).stdout
+    d = tempfile.mkdtemp(prefix="bench-startup-")
+    with open(os.path.join(d, "main.py"), "w", encoding="utf-8") as f:
+        f.write(src)
+    return d
+
+
+def report(label: str, r: dict):
+    print(f"[{label}] import main: {r['import_ms']:.0f} ms（median）")
+    print(f"  import 後已載入：{', '.join(r['loaded']) or '—'}")
+    if "requests_ms" in r:
+        names = ["follow", "偏好", "半徑", "location", "吃什麼", "偏好", "postback", "location"]
+        print("  request 延遲（ms）：" + "  ".join(f"{n}={v:.0f}" for n, v in zip(names, r["requests_ms"])))
+        print(f"  第一個 request：{r['requests_ms'][0]:.0f} ms，import + 第一個 request："
+              f"{r['import_ms'] + r['requests_ms'][0]:.0f} ms")
+        print(f"  跑完後已載入：{', '.join(r['loaded_after'])}")
+
+
+def main_() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--ref", help="另外量這個 git ref 的 main.py 做比較")
+    ap.add_argument("--line-latency-ms", type=float, default=40)
+    ap.add_argument("--places-latency-ms", type=float, default=150)
+    args = ap.parse_args()
+
+    standin = StandIn(args.line_latency_ms, args.places_latency_ms).start()
+    env = {
+        **os.environ,
+        "BENCH_DIR": HERE,
+        "BENCH_HEAVY": json.dumps(HEAVY),
+        "LINE_CHANNEL_SECRET": "bench-secret",
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "PLACES_API_KEY": "bench-key",
+        "LINE_API_BASE": standin.url,
+        "PLACES_API_BASE": standin.url,
+        "GOOGLE_CLOUD_PROJECT": "bench",
+    }
+    try:
+        targets = [("目前", FUNCTIONS_DIR)]
+        if args.ref:
+            targets.append((args.ref, source_at(args.ref)))
+        for label, d in targets:
+            with open(os.path.join(d, "main.py"), encoding="utf-8") as f:
+                supports_base = "LINE_API_BASE" in f.read()
+            run_env = {**env, "BENCH_REQUESTS": "1" if supports_base else "0"}
+            report(label, measure(d, args.runs, run_env))
+    finally:
+        standin.stop()
+
+
+if __name__ == "__main__":
+    main_()
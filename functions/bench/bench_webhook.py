@@ -0,0 +1,254 @@
+"""
+line() webhook 離線 replay 壓測：LINE / Places 打到本機 stand-in server，
+Firestore 用記憶體版（預設）或 Firestore emulator（--emulator，需先設 FIRESTORE_EMULATOR_HOST）。
+
+輸出每個並行度的 p50 / p95 / p99 延遲、吞吐量，以及每個事件平均的後端呼叫次數。
+
+用法（在 functions/ 下）：
+    python bench/bench_webhook.py --users 40 --concurrency 1,4,16
+    python bench/bench_webhook.py --replay recorded.jsonl --concurrency 1,8
+    python bench/bench_webhook.py --webhook-mode queue      # 快速回應模式：另外列出 worker 端延遲
+    python bench/bench_webhook.py --redeliver-rate 0.3      # 模擬 LINE 重送（isRedelivery=true）
+
+--replay 檔案每行一個 webhook body（{"events": [...]}）或單一 event；
+同一 userId 的 body 會交給同一個 worker 依序送出。
+"""
+import argparse, base64, contextlib, hashlib, hmac, json, os, sys, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+from standin import StandIn  # noqa: E402
+
+SECRET = "bench-secret"
+LAT, LNG = 22.9970, 120.2127
+
+
+def scenario(uid: str, i: int) -> list[dict]:
+    """一位使用者的完整流程：follow → 偏好 → 半徑 → 分享位置 → 吃什麼 → 偏好 → postback 改半徑 → 再分享位置"""
+    foods = ["拉麵", "牛肉麵", "咖哩飯", "滷味", "燒臘"]
+    base = {"source": {"type": "user", "userId": uid}, "mode": "active"}
+
+    def ev(n: int, **kw) -> dict:
+        return {**base, "timestamp": int(time.time() * 1000), "replyToken": f"rt-{uid}-{n}",
+                "webhookEventId": f"{uid}-{n}", "deliveryContext": {"isRedelivery": False}, **kw}
+
+    def text(n: int, t: str) -> dict:
+        return ev(n, type="message", message={"id": f"m{n}", "type": "text", "text": t})
+
+    def loc(n: int) -> dict:
+        return ev(n, type="message", message={"id": f"m{n}", "type": "location", "address": "台南",
+                                              "latitude": LAT + (i % 7) * 0.0004, "longitude": LNG})
+
+    return [
+        ev(0, type="follow"),
+        text(1, foods[i % len(foods)]),
+        text(2, "1000m"),
+        loc(3),
+        text(4, "吃什麼"),
+        text(5, foods[(i + 1) % len(foods)]),
+        ev(6, type="postback", postback={"data": "radius=2000"}),
+        loc(7),
+    ]
+
+
+def load_replay(path: str) -> list[dict]:
+    bodies = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                d = json.loads(line)
+                bodies.append(d if "events" in d else {"destination": "bench", "events": [d]})
+    return bodies
+
+
+def make_request(body: dict):
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+    raw = json.dumps(body, ensure_ascii=False).encode()
+    sig = base64.b64encode(hmac.new(SECRET.encode(), raw, hashlib.sha256).digest()).decode()
+    env = EnvironBuilder(method="POST", path="/line", data=raw,
+                         headers={"Content-Type": "application/json", "x-line-signature": sig}).get_environ()
+    return Request(env)
+
+
+def with_redeliveries(work: list[list[dict]], rate: float, seed: int = 7) -> list[list[dict]]:
+    """依比例在原 body 後面再送一次同樣的事件（deliveryContext.isRedelivery=true）"""
+    import random
+    rnd = random.Random(seed)
+    out = []
+    for group in work:
+        g = []
+        for body in group:
+            g.append(body)
+            if rnd.random() < rate:
+                evs = [{**e, "deliveryContext": {"isRedelivery": True}} for e in body.get("events") or []]
+                g.append({**body, "events": evs})
+        out.append(g)
+    return out
+
+
+def build_work(replay: list[dict] | None, users: int, concurrency: int) -> list[list[dict]]:
+    """切成「每組同一使用者、依序送出」的工作；合成流程每個並行度都用一批新使用者"""
+    if replay is not None:
+        by_user: dict[str, list[dict]] = {}
+        for i, body in enumerate(replay):
+            uid = ((body.get("events") or [{}])[0].get("source") or {}).get("userId") or f"_{i}"
+            by_user.setdefault(uid, []).append(body)
+        return list(by_user.values())
+    work = []
+    for u in range(max(users, concurrency)):
+        uid = f"Ubench{concurrency:03d}x{u:05d}"
+        work.append([{"destination": "bench", "events": [e]} for e in scenario(uid, u)])
+    return work
+
+
+def pct(xs: list[float], p: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, max(0, int(round(p / 100 * len(xs) + 0.5)) - 1))]
+
+
+def inbox_latencies(db) -> dict[str, float]:
+    """記憶體版 Firestore 裡已處理完的 webhook_inbox：doc id → latencyMs"""
+    return {path: d["latencyMs"] for path, d in db.dump().items()
+            if path.startswith("webhook_inbox/") and "latencyMs" in d}
+
+
+def run_level(main, standin, fs_stats, work: list[list[dict]], concurrency: int, db=None) -> dict:
+    """
+    work：每個元素是一組要依序送出的 body（同一使用者）；concurrency 組同時跑。
+    queue 模式（db 有 trigger）時等 worker 全部跑完，另外統計 inbox 端延遲。
+    """
+    lat: list[float] = []
+    n_events = sum(len(b.get("events") or []) for group in work for b in group)
+    http0, fs0 = standin.snapshot(), fs_stats()
+    errors = Counter()
+
+    def run_group(group: list[dict]):
+        out = []
+        for body in group:
+            req = make_request(body)
+            t0 = time.perf_counter()
+            try:
+                resp = main.line(req)
+                if resp.status_code != 200:
+                    errors[resp.status_code] += 1
+            except Exception as e:   # noqa: BLE001 壓測只統計
+                errors[type(e).__name__] += 1
+            out.append(time.perf_counter() - t0)
+        return out
+
+    main._places_cache.clear()
+    queued0 = inbox_latencies(db) if db is not None else {}
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for xs in pool.map(run_group, work):
+            lat.extend(xs)
+    if db is not None:
+        db.drain()
+    wall = time.perf_counter() - t0
+    worker = [v / 1e3 for k, v in inbox_latencies(db).items() if k not in queued0] if db is not None else []
+
+    http = standin.snapshot() - http0
+    fs1 = fs_stats()
+    fs = {k: fs1[k] - fs0.get(k, 0) for k in fs1}
+    per = lambda v: v / max(1, n_events)   # noqa: E731
+    return {
+        "concurrency": concurrency,
+        "requests": len(lat),
+        "events": n_events,
+        "req_per_s": len(lat) / wall if wall else 0.0,
+        "ev_per_s": n_events / wall if wall else 0.0,
+        "p50_ms": pct(lat, 50) * 1e3,
+        "p95_ms": pct(lat, 95) * 1e3,
+        "p99_ms": pct(lat, 99) * 1e3,
+        "worker_p50_ms": pct(worker, 50) * 1e3,
+        "worker_p95_ms": pct(worker, 95) * 1e3,
+        "line_calls_per_ev": per(sum(v for k, v in http.items() if k.startswith("line."))),
+        "places_calls_per_ev": per(sum(v for k, v in http.items() if k.startswith("places."))),
+        "fs_reads_per_ev": per(fs.get("reads", 0)),
+        "fs_writes_per_ev": per(fs.get("writes", 0)),
+        "fs_rpcs_per_ev": per(fs.get("rpcs", 0)),
+        "http_calls": dict(http),
+        "errors": dict(errors),
+    }
+
+
+def main_() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=20, help="合成流程的使用者數（每個並行度各自一批新使用者）")
+    ap.add_argument("--concurrency", default="1,4,16")
+    ap.add_argument("--replay", help="錄製的 webhook body（JSONL）")
+    ap.add_argument("--line-latency-ms", type=float, default=40)
+    ap.add_argument("--places-latency-ms", type=float, default=150)
+    ap.add_argument("--empty-rate", type=float, default=0.0, help="Places 回 ZERO_RESULTS 的比例")
+    ap.add_argument("--emulator", action="store_true", help="改用 FIRESTORE_EMULATOR_HOST 指到的 emulator")
+    ap.add_argument("--json", action="store_true", help="輸出 JSON")
+    ap.add_argument("--verbose", action="store_true", help="保留 main.py 的 print 輸出")
+    ap.add_argument("--redeliver-rate", type=float, default=0.0, help="重送比例（同一 webhookEventId 再送一次）")
+    ap.add_argument("--webhook-mode", choices=("sync", "queue"), default="sync",
+                    help="queue：line() 只寫 webhook_inbox，事件由模擬的 lineWorker trigger 處理")
+    args = ap.parse_args()
+
+    standin = StandIn(args.line_latency_ms, args.places_latency_ms, args.empty_rate).start()
+    os.environ.update({
+        "LINE_CHANNEL_SECRET": SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "PLACES_API_KEY": "bench-key",
+        "LINE_API_BASE": standin.url,
+        "PLACES_API_BASE": standin.url,
+        "WEBHOOK_MODE": args.webhook_mode,
+    })
+    import main  # 環境變數設好才能 import
+
+    trigger_db = None
+    if args.emulator:
+        if args.webhook_mode == "queue":
+            sys.exit("--webhook-mode queue 只支援記憶體版 Firestore（emulator 不會觸發 lineWorker）")
+        if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+            sys.exit("--emulator 需要先設定 FIRESTORE_EMULATOR_HOST")
+        os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "bench")
+        fs_stats = lambda: {}   # noqa: E731 emulator 不提供讀寫統計
+    else:
+        from fake_firestore import FakeFirestore
+        main._db = FakeFirestore()
+        fs_stats = main._db.stats.snapshot
+        if args.webhook_mode == "queue":
+            main._db.on_create(main.WEBHOOK_INBOX_COLLECTION, main.process_inbox)
+            trigger_db = main._db
+    main.get_db().collection("settings").document("maps").set({"enabled": True})
+    main.get_db().collection("settings").document("replies").set({"cardsPerReply": 5})
+
+    replay = load_replay(args.replay) if args.replay else None
+    results = []
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with quiet:
+        for c in (int(x) for x in args.concurrency.split(",")):
+            work = with_redeliveries(build_work(replay, args.users, c), args.redeliver_rate)
+            results.append(run_level(main, standin, fs_stats, work, c, trigger_db))
+    standin.stop()
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f"{'conc':>4} {'req':>6} {'req/s':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} "
+          f"{'LINE/ev':>8} {'Places/ev':>9} {'FSr/ev':>7} {'FSw/ev':>7} {'FSrpc/ev':>8}  errors")
+    for r in results:
+        print(f"{r['concurrency']:>4} {r['requests']:>6} {r['req_per_s']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['line_calls_per_ev']:>8.2f} "
+              f"{r['places_calls_per_ev']:>9.2f} {r['fs_reads_per_ev']:>7.2f} {r['fs_writes_per_ev']:>7.2f} "
+              f"{r['fs_rpcs_per_ev']:>8.2f}  {r['errors'] or ''}")
+    if args.webhook_mode == "queue":
+        print("（queue 模式：上表延遲為 ack；worker 端 收到→處理完）")
+        for r in results:
+            print(f"{r['concurrency']:>4} worker p50 {r['worker_p50_ms']:.1f} ms, p95 {r['worker_p95_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main_()
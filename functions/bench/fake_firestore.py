@@ -0,0 +1,318 @@
+"""
+壓測用的記憶體版 Firestore：只實作 main.py 用到的子集（document / collection / query /
+batch / bulk_writer / get_all / transforms），並統計讀、寫與 RPC 次數。
+on_create() 可模擬 Firestore onCreate trigger（背景執行緒呼叫）。
+
+用法：
+    from fake_firestore import FakeFirestore
+    main._db = FakeFirestore()
+"""
+import copy, datetime, threading, uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1 import ArrayRemove, ArrayUnion, DELETE_FIELD, Increment, SERVER_TIMESTAMP
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reads = self.writes = self.rpcs = 0
+
+    def add(self, reads: int = 0, writes: int = 0, rpcs: int = 1):
+        with self._lock:
+            self.reads += reads
+            self.writes += writes
+            self.rpcs += rpcs
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"reads": self.reads, "writes": self.writes, "rpcs": self.rpcs}
+
+
+def _nest(fields: dict) -> dict:
+    """update() 用的 "a.b.c" 欄位路徑轉成巢狀 dict"""
+    out: dict = {}
+    for path, v in fields.items():
+        *head, leaf = path.split(".")
+        node = out
+        for p in head:
+            node = node.setdefault(p, {})
+        node[leaf] = v
+    return out
+
+
+def _apply(dst: dict, src: dict):
+    for k, v in src.items():
+        cur = dst.get(k)
+        if v is DELETE_FIELD:
+            dst.pop(k, None)
+        elif v is SERVER_TIMESTAMP:
+            dst[k] = datetime.datetime.now(datetime.timezone.utc)
+        elif isinstance(v, dict):
+            if not isinstance(cur, dict):
+                cur = dst[k] = {}
+            _apply(cur, v)
+        elif isinstance(v, Increment):
+            dst[k] = (cur if isinstance(cur, (int, float)) else 0) + v.value
+        elif isinstance(v, ArrayUnion):
+            lst = list(cur) if isinstance(cur, list) else []
+            dst[k] = lst + [x for x in v.values if x not in lst]
+        elif isinstance(v, ArrayRemove):
+            dst[k] = [x for x in (cur if isinstance(cur, list) else []) if x not in v.values]
+        else:
+            dst[k] = copy.deepcopy(v)
+
+
+def _field(data: dict, path: str):
+    node = data
+    for p in path.split("."):
+        if not isinstance(node, dict) or p not in node:
+            return None
+        node = node[p]
+    return node
+
+
+class Snapshot:
+    def __init__(self, ref: "DocumentReference", data: dict | None):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> dict | None:
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field: str):
+        return _field(self._data or {}, field)
+
+
+class DocumentReference:
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "CollectionReference":
+        return CollectionReference(self._db, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction=None) -> Snapshot:
+        self._db.stats.add(reads=1)
+        return self._db._snapshot(self)
+
+    def set(self, data: dict, merge: bool = False):
+        self._db.stats.add(writes=1)
+        self._db._write("set", self, data, merge)
+
+    def update(self, data: dict):
+        self._db.stats.add(writes=1)
+        self._db._write("update", self, data)
+
+    def create(self, data: dict):
+        self._db.stats.add(writes=1)
+        self._db._write("create", self, data)
+
+    def delete(self):
+        self._db.stats.add(writes=1)
+        self._db._write("delete", self, None)
+
+
+class Query:
+    _OPS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        ">": lambda a, b: a is not None and a > b,
+        ">=": lambda a, b: a is not None and a >= b,
+        "<": lambda a, b: a is not None and a < b,
+        "<=": lambda a, b: a is not None and a <= b,
+        "in": lambda a, b: a in b,
+        "array_contains": lambda a, b: isinstance(a, list) and b in a,
+        "array_contains_any": lambda a, b: isinstance(a, list) and any(x in a for x in b),
+    }
+
+    def __init__(self, db: "FakeFirestore", path: str, filters=(), limit_n=None, after=None, fields=None, orders=()):
+        self._db, self._path = db, path
+        self._filters, self._limit, self._after, self._fields = tuple(filters), limit_n, after, fields
+        self._orders = tuple(orders)
+
+    def _clone(self, **kw) -> "Query":
+        args = {"filters": self._filters, "limit_n": self._limit, "after": self._after, "fields": self._fields,
+                "orders": self._orders}
+        args.update(kw)
+        return Query(self._db, self._path, **args)
+
+    def where(self, field: str, op: str, value) -> "Query":
+        return self._clone(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field: str, direction: str = "ASCENDING") -> "Query":
+        return self._clone(orders=self._orders + ((field, direction),))
+
+    def limit(self, n: int) -> "Query":
+        return self._clone(limit_n=n)
+
+    def select(self, fields) -> "Query":
+        return self._clone(fields=list(fields))
+
+    def start_after(self, snapshot: Snapshot) -> "Query":
+        return self._clone(after=snapshot.id)
+
+    def get(self, transaction=None) -> list[Snapshot]:
+        out = []
+        rows = self._db._children(self._path)   # 已依文件 ID 排序
+        for field, direction in reversed(self._orders):
+            if field != "__name__":
+                rows.sort(key=lambda rd: (_field(rd[1], field) is None, _field(rd[1], field)),
+                          reverse=direction == "DESCENDING")
+        for ref, data in rows:
+            if self._after is not None and ref.id <= self._after:
+                continue
+            if not all(self._OPS[op](_field(data, f), v) for f, op, v in self._filters):
+                continue
+            if self._fields is not None:
+                data = {f: _field(data, f) for f in self._fields if _field(data, f) is not None}
+            out.append(Snapshot(ref, data))
+            if self._limit is not None and len(out) >= self._limit:
+                break
+        self._db.stats.add(reads=max(1, len(out)))
+        return out
+
+    def stream(self, transaction=None):
+        return iter(self.get())
+
+
+class CollectionReference(Query):
+    def __init__(self, db: "FakeFirestore", path: str):
+        super().__init__(db, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id: str | None = None) -> DocumentReference:
+        return DocumentReference(self._db, f"{self._path}/{doc_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data: dict):
+        ref = self.document()
+        ref.set(data)
+        return datetime.datetime.now(datetime.timezone.utc), ref
+
+    def on_snapshot(self, callback):
+        raise NotImplementedError("FakeFirestore 不支援 on_snapshot")
+
+
+class WriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops: list = []
+
+    def set(self, ref, data, merge: bool = False):
+        self._ops.append(("set", ref, data, merge))
+
+    def update(self, ref, data):
+        self._ops.append(("update", ref, data, False))
+
+    def create(self, ref, data):
+        self._ops.append(("create", ref, data, False))
+
+    def delete(self, ref):
+        self._ops.append(("delete", ref, None, False))
+
+    def commit(self):
+        if not self._ops:
+            return []
+        self._db.stats.add(writes=len(self._ops))
+        for op, ref, data, merge in self._ops:
+            self._db._write(op, ref, data, merge)
+        self._ops = []
+        return []
+
+    # BulkWriter 介面
+    def flush(self):
+        self.commit()
+
+    def close(self):
+        self.commit()
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._docs: dict[str, dict] = {}
+        self._lock = threading.RLock()
+        self.stats = Stats()
+        self._triggers: list[tuple[str, object]] = []
+        self._trigger_pool: ThreadPoolExecutor | None = None
+        self._trigger_futs: list = []
+
+    # ── 公開 API（對應 google.cloud.firestore.Client） ──
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self, name)
+
+    def document(self, path: str) -> DocumentReference:
+        return DocumentReference(self, path)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def bulk_writer(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def get_all(self, refs, field_paths=None, transaction=None):
+        refs = list(refs)
+        self.stats.add(reads=len(refs))
+        return [self._snapshot(r) for r in refs]
+
+    # ── 模擬 trigger ──
+    def on_create(self, collection: str, fn, workers: int = 8):
+        """collection 下新建文件時，在背景執行 fn(doc_id, data)（像 onDocumentCreated）"""
+        self._triggers.append((collection, fn))
+        if self._trigger_pool is None:
+            self._trigger_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="trigger")
+
+    def drain(self):
+        """等所有已觸發的 fn 跑完（含跑的過程中又觸發的）"""
+        while True:
+            with self._lock:
+                futs, self._trigger_futs = self._trigger_futs, []
+            if not futs:
+                return
+            wait(futs)
+
+    # ── 內部 ──
+    def _snapshot(self, ref: DocumentReference) -> Snapshot:
+        with self._lock:
+            data = self._docs.get(ref.path)
+            return Snapshot(ref, copy.deepcopy(data) if data is not None else None)
+
+    def _children(self, coll_path: str):
+        depth = coll_path.count("/") + 1
+        with self._lock:
+            items = sorted((p, copy.deepcopy(d)) for p, d in self._docs.items()
+                           if p.startswith(coll_path + "/") and p.count("/") == depth)
+        return [(DocumentReference(self, p), d) for p, d in items]
+
+    def _write(self, op: str, ref: DocumentReference, data: dict | None, merge: bool = False):
+        with self._lock:
+            cur = self._docs.get(ref.path)
+            if op == "delete":
+                self._docs.pop(ref.path, None)
+                return
+            if op == "create" and cur is not None:
+                raise AlreadyExists(ref.path)
+            if op == "update":
+                if cur is None:
+                    raise NotFound(ref.path)
+                data = _nest(data)
+            doc = cur if (cur is not None and (merge or op == "update")) else {}
+            _apply(doc, data or {})
+            self._docs[ref.path] = doc
+            if cur is None:
+                coll = ref.path.rsplit("/", 1)[0]
+                for name, fn in self._triggers:
+                    if name == coll:
+                        self._trigger_futs.append(
+                            self._trigger_pool.submit(fn, ref.id, copy.deepcopy(doc)))
+
+    def dump(self) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._docs)
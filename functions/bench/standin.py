@@ -0,0 +1,126 @@
+"""
+本機 stand-in server：模擬 api.line.me 與 maps.googleapis.com（Places nearby / text search / photo），
+可設定延遲，並統計每個路由被呼叫的次數。
+
+    srv = StandIn(line_latency_ms=40, places_latency_ms=150).start()
+    os.environ["LINE_API_BASE"] = os.environ["PLACES_API_BASE"] = srv.url
+"""
+import hashlib, json, random, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+NAMES = ["牛肉麵", "拉麵", "滷味", "燒臘", "咖哩飯", "早午餐", "咖啡", "便當", "火鍋", "小吃"]
+
+
+def fake_places(params: dict, n: int = 20, empty_rate: float = 0.0) -> dict:
+    """依查詢參數產生固定的假結果（同樣參數 → 同樣結果，快取行為才測得出來）"""
+    seed = hashlib.sha1(json.dumps(params, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    rnd = random.Random(seed)
+    if rnd.random() < empty_rate:
+        return {"status": "ZERO_RESULTS", "results": []}
+    lat, lng = (float(x) for x in params.get("location", "22.997,120.2127").split(","))
+    word = params.get("keyword") or params.get("query") or rnd.choice(NAMES)
+    results = []
+    for i in range(n):
+        pid = f"bench-{seed[:8]}-{i}"
+        results.append({
+            "place_id": pid,
+            "name": f"{word.split('|')[0]} {i}號店",
+            "geometry": {"location": {"lat": lat + rnd.uniform(-0.008, 0.008),
+                                      "lng": lng + rnd.uniform(-0.008, 0.008)}},
+            "rating": round(rnd.uniform(3.0, 5.0), 1),
+            "user_ratings_total": rnd.randint(0, 2000),
+            "vicinity": f"台南市中西區測試路 {i} 號",
+            "photos": [{"photo_reference": f"ref-{pid}"}],
+        })
+    return {"status": "OK", "results": results}
+
+
+class StandIn:
+    def __init__(self, line_latency_ms: float = 40, places_latency_ms: float = 150, empty_rate: float = 0.0):
+        self.line_latency = line_latency_ms / 1000
+        self.places_latency = places_latency_ms / 1000
+        self.empty_rate = empty_rate
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, route: str):
+        with self._lock:
+            self.calls[route] += 1
+
+    def snapshot(self) -> Counter:
+        with self._lock:
+            return Counter(self.calls)
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> "StandIn":
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive，才量得到連線池效果
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict):
+                raw = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_GET(self):
+                u = urlparse(self.path)
+                if u.path.startswith("/v2/bot/profile/"):
+                    standin.count("line.profile")
+                    time.sleep(standin.line_latency)
+                    uid = u.path.rsplit("/", 1)[-1]
+                    return self._send(200, {"userId": uid, "displayName": f"bench-{uid[-4:]}",
+                                            "pictureUrl": None, "statusMessage": ""})
+                if u.path == "/maps/api/place/photo":
+                    standin.count("places.photo")
+                    time.sleep(standin.places_latency)
+                    raw = b"\xff\xd8\xff\xe0" + hashlib.sha1(u.query.encode()).digest() * 64 + b"\xff\xd9"
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/jpeg")
+                    self.send_header("Content-Length", str(len(raw)))
+                    self.end_headers()
+                    return self.wfile.write(raw)
+                if u.path.startswith("/maps/api/place/"):
+                    kind = u.path.split("/")[-2]          # nearbysearch | textsearch
+                    standin.count(f"places.{kind}")
+                    time.sleep(standin.places_latency)
+                    params = {k: v[0] for k, v in parse_qs(u.query).items() if k != "key"}
+                    return self._send(200, fake_places(params, empty_rate=standin.empty_rate))
+                self._send(404, {"message": "not found"})
+
+            def do_POST(self):
+                u = urlparse(self.path)
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if u.path == "/v2/bot/message/reply":
+                    standin.count("line.reply")
+                elif u.path == "/v2/bot/message/multicast":
+                    standin.count("line.multicast")
+                elif u.path == "/v2/bot/message/push":
+                    standin.count("line.push")
+                else:
+                    return self._send(404, {"message": "not found"})
+                time.sleep(standin.line_latency)
+                self._send(200, {})
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
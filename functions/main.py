@@ -1,30 +1,44 @@
 # Cloud Functions for Firebase (Python)
 # LINE Webhook + 使用者資料/對話紀錄寫入 Firestore + Places + 距離選擇
-from firebase_functions import https_fn
+from __future__ import annotations   # 型別註記不在 import 時求值（httpx 等才能懶載入）
+
+# firebase_functions 本身就會載入 firebase_admin / google.cloud.firestore_v1 / asyncio，
+# 這裡再 import 不增加成本；httpx 與 Admin SDK 初始化則延到第一次用到才做。
+from firebase_functions import https_fn, firestore_fn, scheduler_fn
 from firebase_functions.options import set_global_options
+import firebase_admin
 from firebase_admin import firestore
-from math import radians, sin, cos, asin, sqrt
-import os, json, hmac, hashlib, base64, datetime
-import httpx
+from google.cloud.firestore_v1 import Increment, ArrayUnion
+from google.api_core.exceptions import AlreadyExists, NotFound
+from math import radians, sin, cos, asin, sqrt, exp
+import os, sys, io, json, hmac, hashlib, base64, datetime
 from urllib.parse import quote as urlquote
 from urllib.parse import urlparse, parse_qs
 import unicodedata, re
-from google.cloud.firestore_v1 import Increment, ArrayUnion
-from math import radians, sin, cos, asin, sqrt
-import time
-from typing import Dict, Any
-
-import firebase_admin
-from firebase_admin import firestore as _fs
-import asyncio
-from firebase_admin import auth as _auth
-
-# 初始化 Admin SDK（若已初始化會跳過）
-if not firebase_admin._apps:
-    firebase_admin.initialize_app()
-
-# ── Theme 快取（60s） ─────────────────────────────
-_THEME_CACHE: Dict[str, Any] = {"data": None, "exp": 0}
+import time, threading, uuid, random, contextvars, asyncio
+import importlib.util
+from contextlib import contextmanager
+from typing import Dict, Any, Iterable
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+def _lazy_import(name: str):
+    """
+    回傳一個延遲載入的 module：第一次存取屬性時才真正執行 import。
+    （importlib.util.LazyLoader 的標準用法；已載入過就直接用現成的）
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+httpx = _lazy_import("httpx")   # 只有真的送出 HTTP 請求時才載入（約佔 import 時間的 1/4）
 
 # ── Global options / Secrets ───────────────────────────────────────────────
 set_global_options(
@@ -35,16 +49,214 @@ set_global_options(
 
 # 懶載入 Firestore（避免本機沒有 ADC 時在 import 階段就爆）
 _db = None
+_db_lock = threading.Lock()
+
+def _admin_app():
+    """初始化 Admin SDK（第一次用到 Firestore / Auth 時才做；已初始化會跳過）"""
+    if not firebase_admin._apps:
+        with _db_lock:
+            if not firebase_admin._apps:
+                firebase_admin.initialize_app()
+
 def get_db():
     global _db
     if _db is None:
-        _db = firestore.client()
+        _admin_app()
+        with _db_lock:  # 事件會在多執行緒並行處理，避免重複建立 client
+            if _db is None:
+                _db = firestore.client()
     return _db
 
 LINE_TOKEN  = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN", "")
 LINE_SECRET = os.environ.get("LINE_CHANNEL_SECRET", "")
 PLACES_KEY  = os.environ.get("PLACES_API_KEY", "")
+# 同一批 webhook 內，不同使用者的事件最多同時處理幾組
+EVENT_CONCURRENCY = int(os.environ.get("LINE_EVENT_CONCURRENCY", "4"))
 LIFF_SLOT_URL = os.environ.get("LIFF_SLOT_URL", "https://YOUR_HOSTING_DOMAIN/liff/slot.html")
+# sync（預設）：line() 處理完所有事件才回 200；queue：驗簽後寫進 webhook_inbox 立即回 200，由 lineWorker 處理
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "sync")
+# API 位址（本機壓測 / replay 時可指到 stand-in server）
+LINE_API_BASE   = os.environ.get("LINE_API_BASE", "https://api.line.me").rstrip("/")
+PLACES_API_BASE = os.environ.get("PLACES_API_BASE", "https://maps.googleapis.com").rstrip("/")
+
+# ── 追蹤（trace spans）：每個事件一行 JSON log，記錄各階段耗時與呼叫次數 ───────
+# TRACE_SAMPLE：0 = 關閉（預設），1 = 全部，0.1 = 抽 10% 的 webhook request。
+# 關閉時 span() / trace_count() 只查一次 contextvar 就回傳，幾乎沒有額外成本。
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "0"))
+
+# None = 尚未決定；False = 此 request 未抽中；Trace = 追蹤中
+_trace_var: "contextvars.ContextVar[Trace | bool | None]" = contextvars.ContextVar("trace", default=None)
+
+class Trace:
+    """一個 request 或事件的追蹤：stages 為各階段累計秒數，counts 為呼叫次數（多執行緒共用）"""
+
+    def __init__(self, kind: str, trace_id: str, **attrs):
+        self.kind = kind
+        self.trace_id = trace_id
+        self.attrs = attrs
+        self.t0 = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, sec: float):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + sec
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def emit(self):
+        # Cloud Logging 會把單行 JSON 解析成 jsonPayload
+        print(json.dumps({
+            "message": f"TRACE {self.kind}",
+            "trace": self.kind,
+            "traceId": self.trace_id,
+            **self.attrs,
+            "ms": round((time.perf_counter() - self.t0) * 1000, 2),
+            "stages": {k: round(v * 1000, 2) for k, v in self.stages.items()},
+            "counts": self.counts,
+        }, ensure_ascii=False, default=str))
+
+class _Span:
+    __slots__ = ("trace", "name", "t0")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace, self.name = trace, name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add_stage(self.name, time.perf_counter() - self.t0)
+        return False
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name: str):
+    """with span("user.load"): ... ；沒有追蹤中的 trace 時是 no-op"""
+    tr = _trace_var.get()
+    return _Span(tr, name) if tr else _NO_SPAN
+
+def trace_count(name: str, n: int = 1):
+    tr = _trace_var.get()
+    if tr:
+        tr.incr(name, n)
+
+def trace_attr(**attrs):
+    tr = _trace_var.get()
+    if tr:
+        tr.attrs.update(attrs)
+
+@contextmanager
+def trace_scope(kind: str, **attrs):
+    """
+    開一個追蹤範圍，結束時輸出一行 JSON。
+    外層已有 trace（例如 webhook request）時沿用它的抽樣結果與 traceId，
+    否則依 TRACE_SAMPLE 抽樣。
+    """
+    parent = _trace_var.get()
+    if parent is False or (parent is None and (TRACE_SAMPLE <= 0 or random.random() >= TRACE_SAMPLE)):
+        token = _trace_var.set(False)
+        try:
+            yield None
+        finally:
+            _trace_var.reset(token)
+        return
+    tr = Trace(kind, parent.trace_id if parent else uuid.uuid4().hex[:16], **attrs)
+    token = _trace_var.set(tr)
+    try:
+        yield tr
+    except BaseException as e:
+        tr.attrs["err"] = repr(e)[:300]
+        raise
+    finally:
+        _trace_var.reset(token)
+        tr.emit()
+
+def traced_submit(executor: ThreadPoolExecutor, fn, *args, **kwargs):
+    """executor.submit，但把目前的 trace（contextvars）帶進 worker 執行緒"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+# ── HTTP clients（連線池 / keep-alive / HTTP2，跨 invocation 重用） ────────────
+# 各 endpoint 的 timeout 與重試次數集中在這裡調整
+HTTP_ENDPOINTS: Dict[str, Dict[str, Any]] = {
+    "line_reply":     {"host": "line",   "timeout": 10.0, "retries": 0},  # replyToken 只能用一次，不重試
+    "line_profile":   {"host": "line",   "timeout": 8.0,  "retries": 1},
+    "line_multicast": {"host": "line",   "timeout": 15.0, "retries": 0},
+    "line_push":      {"host": "line",   "timeout": 10.0, "retries": 1},  # 帶 X-Line-Retry-Key，重試不會重複送
+    "places":         {"host": "places", "timeout": 10.0, "retries": 1},
+    "places_photo":   {"host": "places", "timeout": 10.0, "retries": 1},
+    "drive_thumbnail": {"host": "drive", "timeout": 10.0, "retries": 1},
+}
+# 每個 host 一個 client，連線池上限即為 per-host limit
+# （httpx.Limits 的參數；建立 client 時才轉成 Limits，import 時不碰 httpx）
+HTTP_LIMITS: Dict[str, Dict[str, Any]] = {
+    "line":   {"max_connections": 20, "max_keepalive_connections": 10, "keepalive_expiry": 60.0},
+    "places": {"max_connections": 20, "max_keepalive_connections": 10, "keepalive_expiry": 60.0},
+    "drive":  {"max_connections": 10, "max_keepalive_connections": 5,  "keepalive_expiry": 60.0},
+}
+HTTP_RETRY_STATUS = {429, 500, 502, 503, 504}
+HTTP_RETRY_BACKOFF_SEC = 0.2
+
+def _http2() -> bool:
+    """httpx 的 HTTP/2 需要 h2（httpx[http2]）；建立 client 時才檢查"""
+    return importlib.util.find_spec("h2") is not None
+
+_http_clients: Dict[str, httpx.Client] = {}
+_http_lock = threading.Lock()
+
+def get_http(host: str) -> httpx.Client:
+    """取得（懶建立）該 host 共用的 httpx.Client"""
+    c = _http_clients.get(host)
+    if c is None:
+        with _http_lock:
+            c = _http_clients.get(host)
+            if c is None:
+                c = _http_clients[host] = httpx.Client(http2=_http2(), limits=httpx.Limits(**HTTP_LIMITS[host]))
+    return c
+
+def _retry_delay(r: httpx.Response | None, attempt: int) -> float:
+    delay = HTTP_RETRY_BACKOFF_SEC * (2 ** attempt)
+    try:
+        if r is not None and r.headers.get("Retry-After"):
+            delay = max(delay, min(5.0, float(r.headers["Retry-After"])))
+    except ValueError:
+        pass
+    return delay
+
+def http_request(endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+    """
+    以 HTTP_ENDPOINTS[endpoint] 的設定送出請求：共用連線池、固定 timeout，
+    遇到連線錯誤或 429/5xx 在重試額度內退避重送。最後一次的回應原樣回傳。
+    """
+    cfg = HTTP_ENDPOINTS[endpoint]
+    retries = int(cfg.get("retries") or 0)
+    for attempt in range(retries + 1):
+        trace_count(f"http.{endpoint}")
+        try:
+            with span(f"http.{endpoint}"):
+                r = get_http(cfg["host"]).request(method, url, timeout=cfg["timeout"], **kwargs)
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+            time.sleep(_retry_delay(None, attempt))
+            continue
+        if r.status_code in HTTP_RETRY_STATUS and attempt < retries:
+            time.sleep(_retry_delay(r, attempt))
+            continue
+        return r
 
 # ── LINE helpers ───────────────────────────────────────────────────────────
 def verify_signature(raw_body: bytes, signature: str) -> bool:
@@ -52,53 +264,83 @@ def verify_signature(raw_body: bytes, signature: str) -> bool:
     expected = base64.b64encode(mac).decode()
     return hmac.compare_digest(signature or "", expected)
 
+# replyToken → (userId, 期限)：只有 lineWorker 處理佇列事件時才會設定；
+# 過了期限（或 LINE 回 Invalid reply token）改用 push 傳給該使用者
+_reply_fallback: "contextvars.ContextVar[Dict[str, tuple[str, float]] | None]" = \
+    contextvars.ContextVar("reply_fallback", default=None)
+
 def line_reply(reply_token: str, messages: list) -> bool:
+    route = (_reply_fallback.get() or {}).get(reply_token)
+    if route and time.time() > route[1]:
+        return line_push(route[0], messages)
     try:
-        r = httpx.post(
-            "https://api.line.me/v2/bot/message/reply",
+        r = http_request(
+            "line_reply", "POST",
+            f"{LINE_API_BASE}/v2/bot/message/reply",
             headers={"Authorization": f"Bearer {LINE_TOKEN}", "Content-Type": "application/json"},
-            json={"replyToken": reply_token, "messages": messages},
-            timeout=10.0
+            content=json_bytes({"replyToken": reply_token, "messages": messages}),
         )
+        if route and r.status_code == 400 and "reply token" in r.text.lower():
+            return line_push(route[0], messages)
+        usage_incr("replies.ok" if r.status_code < 400 else "replies.fail")
         if r.status_code >= 400:
             # 看清楚 LINE 回什麼錯（欄位/格式/圖片等）
             print("LINE_REPLY_ERR", {
                 "status": r.status_code,
                 "body": r.text[:2000],
-                "messages_preview": str(messages)[:1000]
+                "messages_preview": json_bytes(messages)[:1000].decode(errors="replace")
             })
             return False
         return True
     except Exception as e:
+        usage_incr("replies.fail")
         print("LINE_REPLY_EXC", repr(e))
         return False
 
+def line_push(uid: str, messages: list) -> bool:
+    """replyToken 不能用時的備援：直接 push 給使用者（會計入 LINE 訊息額度）"""
+    try:
+        r = http_request(
+            "line_push", "POST",
+            f"{LINE_API_BASE}/v2/bot/message/push",
+            headers={"Authorization": f"Bearer {LINE_TOKEN}", "Content-Type": "application/json",
+                     "X-Line-Retry-Key": str(uuid.uuid4())},
+            content=json_bytes({"to": uid, "messages": messages}),
+        )
+        ok = r.status_code < 400 or r.status_code == 409   # 409：同一個 retry key 已經送過
+        usage_incr("replies.push" if ok else "replies.fail")
+        if not ok:
+            print("LINE_PUSH_ERR", {"status": r.status_code, "body": r.text[:2000]})
+        return ok
+    except Exception as e:
+        usage_incr("replies.fail")
+        print("LINE_PUSH_EXC", repr(e))
+        return False
+
 def fetch_line_profile(uid: str) -> dict | None:
     try:
-        r = httpx.get(
-            f"https://api.line.me/v2/bot/profile/{uid}",
+        r = http_request(
+            "line_profile", "GET",
+            f"{LINE_API_BASE}/v2/bot/profile/{uid}",
             headers={"Authorization": f"Bearer {LINE_TOKEN}"},
-            timeout=8.0,
         )
         r.raise_for_status()
         return r.json()
     except httpx.HTTPError:
         return None
 
-# ── Theme (settings/theme) helpers ─────────────────────────────────────────
-THEME_TTL_SEC = 60
-_THEME_CACHE = {"data": None, "exp": 0}
-
-def get_theme(ttl_sec: int = THEME_TTL_SEC) -> dict:
-    import time
-    now = time.time()
-    if _THEME_CACHE["data"] and _THEME_CACHE["exp"] > now:
-        return _THEME_CACHE["data"]
+# ── Settings（settings/theme, maps, replies, ranking, foods：一次 get_all + TTL 快取） ──────
+SETTINGS_TTL_SEC = 60
+SETTINGS_DOCS = ("theme", "maps", "replies", "ranking", "foods")
+# 開啟後以 on_snapshot 監聽 settings 集合，後台修改立即生效（不必等 TTL）
+SETTINGS_LISTEN = os.environ.get("SETTINGS_LISTEN", "") == "1"
 
-    doc = get_db().collection("settings").document("theme").get()
-    data = doc.to_dict() or {}
+_SETTINGS_CACHE: Dict[str, Any] = {"data": None, "exp": 0, "live": False}
+_settings_lock = threading.Lock()
+_settings_watch = None
 
-    theme = {
+def _normalize_theme(data: dict) -> dict:
+    return {
         "btnKind":          (data.get("btnKind") or "secondary"),
         "btnColor":         (data.get("btnColor") or "#E5E7EB").upper(),
         "btnMargin":        (data.get("btnMargin") or "sm"),
@@ -107,19 +349,79 @@ def get_theme(ttl_sec: int = THEME_TTL_SEC) -> dict:
         "fallbackImageUrl": (data.get("fallbackImageUrl") or ""),
     }
 
-    _THEME_CACHE["data"] = theme
-    _THEME_CACHE["exp"]  = now + max(0, int(ttl_sec))
-    return theme
+def _store_settings(docs: dict, ttl_sec: int):
+    data = {name: dict(docs.get(name) or {}) for name in SETTINGS_DOCS}
+    data["theme"] = _normalize_theme(data["theme"])
+    # 樣式有變才會變的版本號：Flex 樣板與卡片快取以此為 key
+    data["themeVersion"] = hashlib.sha1(json.dumps(data["theme"], sort_keys=True).encode()).hexdigest()[:12]
+    # 同義詞字典的版本號：食物詞比對器以此為 key
+    data["foodsVersion"] = hashlib.sha1(json.dumps(data["foods"].get("synonyms") or {}, sort_keys=True,
+                                                   ensure_ascii=False, default=str).encode()).hexdigest()[:12]
+    _SETTINGS_CACHE["data"] = data
+    _SETTINGS_CACHE["exp"]  = time.time() + max(0, int(ttl_sec))
+
+def _on_settings_snapshot(col_snapshot, changes, read_time):
+    try:
+        _store_settings({snap.id: snap.to_dict() for snap in col_snapshot}, SETTINGS_TTL_SEC)
+        _SETTINGS_CACHE["live"] = True
+    except Exception as e:
+        _SETTINGS_CACHE["live"] = False
+        print("SETTINGS_WATCH_EXC", repr(e))
+
+def _start_settings_listener():
+    global _settings_watch
+    if _settings_watch is not None:
+        return
+    try:
+        _settings_watch = get_db().collection("settings").on_snapshot(_on_settings_snapshot)
+    except Exception as e:
+        print("SETTINGS_WATCH_EXC", repr(e))
+
+def get_settings(ttl_sec: int = SETTINGS_TTL_SEC) -> dict:
+    """
+    回傳 {"theme": {...已正規化}, "maps": {...}, "replies": {...}, "ranking": {...}, "foods": {...}}。
+    各文件用一次 get_all 讀回並快取 ttl_sec 秒；監聽中則直接用監聽到的最新值。
+    """
+    if _SETTINGS_CACHE["data"] and (_SETTINGS_CACHE["live"] or _SETTINGS_CACHE["exp"] > time.time()):
+        return _SETTINGS_CACHE["data"]
+
+    with _settings_lock:
+        if _SETTINGS_CACHE["data"] and _SETTINGS_CACHE["exp"] > time.time():
+            return _SETTINGS_CACHE["data"]
+        db = get_db()
+        refs = [db.collection("settings").document(name) for name in SETTINGS_DOCS]
+        with span("settings"):
+            docs = {snap.id: snap.to_dict() for snap in db.get_all(refs) if snap.exists}
+        trace_count("fs.reads", len(refs))
+        _store_settings(docs, ttl_sec)
+        if SETTINGS_LISTEN:
+            _start_settings_listener()
+    return _SETTINGS_CACHE["data"]
+
+def get_theme(ttl_sec: int = SETTINGS_TTL_SEC) -> dict:
+    return get_settings(ttl_sec)["theme"]
+
+def get_theme_version(ttl_sec: int = SETTINGS_TTL_SEC) -> str:
+    return get_settings(ttl_sec)["themeVersion"]
 
 def is_maps_enabled() -> bool:
     """讀取 settings/maps.enabled，預設 True（避免讀不到時誤殺服務）"""
     try:
-        snap = get_db().document("settings/maps").get()
-        if snap.exists:
-            return bool((snap.to_dict() or {}).get("enabled", True))
+        return bool(get_settings()["maps"].get("enabled", True))
     except Exception:
-        pass
-    return True
+        return True
+
+def cards_per_reply() -> int:
+    """讀 settings/replies.cardsPerReply；無則回 5；限制 3~9"""
+    try:
+        n = get_settings()["replies"].get("cardsPerReply", 5)
+    except Exception:
+        n = 5
+    try:
+        n = int(n)
+    except Exception:
+        n = 5
+    return max(3, min(9, n))
 
 def normalize_image_url(url: str, size: int = 1200) -> str:
     """
@@ -148,7 +450,8 @@ def normalize_image_url(url: str, size: int = 1200) -> str:
             file_id = (qs.get("id") or [None])[0]
 
         if file_id:
-            return f"https://drive.google.com/thumbnail?id={file_id}&sz=w{int(size)}"
+            return (photo_proxy_url("d", file_id, size)
+                    or f"https://drive.google.com/thumbnail?id={file_id}&sz=w{int(size)}")
         return u
     except Exception:
         return u
@@ -158,34 +461,31 @@ def _require_admin_from_idtoken(authorization: str) -> str:
     if not authorization or not authorization.startswith("Bearer "):
         raise PermissionError("MISSING_ID_TOKEN")
     id_token = authorization.split(" ", 1)[1]
-    decoded = _auth.verify_id_token(id_token)
+    from firebase_admin import auth   # 只有 adminPush 用得到
+    _admin_app()
+    decoded = auth.verify_id_token(id_token)
     uid = decoded["uid"]
     if not get_db().collection("admins").document(uid).get().exists:
         raise PermissionError("NOT_ADMIN")
     return uid
 
 def _build_single_bubble(title: str, body: str, image: str, btn_label: str, btn_url: str) -> dict:
-    theme     = get_theme()
-    btn_style = "primary" if theme.get("btnKind") == "primary" else "secondary"
-    btn_color = theme.get("btnColor") or "#00B900"
-    aspect    = _aspect_ratio(theme.get("heroRatio"))
-    mode      = _aspect_mode(theme.get("heroMode"))
-    fallback  = theme.get("fallbackImageUrl") or ""
-
-    img_url = normalize_image_url(image or fallback, size=1200)
+    """推播用的單張卡片（回傳 dict：會存進 push_jobs，之後每批只序列化一次）"""
+    tpl = flex_template()
+    img_url = normalize_image_url(image or tpl.theme.get("fallbackImageUrl") or "", size=1200)
 
     bubble = {
         "type": "bubble",
         **({"hero": {
             "type": "image", "url": img_url, "size": "full",
-            "aspectRatio": aspect, "aspectMode": mode
+            "aspectRatio": tpl.aspect, "aspectMode": tpl.mode
         }} if img_url else {}),
         "body": {"type":"box","layout":"vertical","spacing":"sm","contents":[
             {"type":"text","text": (title or "通知"), "weight":"bold","size":"md","wrap":True},
             *([{"type":"text","text": body, "size":"sm","wrap":True}] if body else [])
         ]},
-        "footer":{"type":"box","layout":"vertical","spacing": _gap(theme.get("btnMargin")),
-          "contents":[{"type":"button","style":btn_style,"height":"sm","color":btn_color,
+        "footer":{"type":"box","layout":"vertical","spacing": tpl.spacing,
+          "contents":[{"type":"button","style":tpl.btn_style,"height":"sm","color":tpl.btn_color,
             "action":{"type":"uri","label": (btn_label or "查看詳情"), "uri": (btn_url or "https://google.com")}
           }],"flex":0}
     }
@@ -196,95 +496,468 @@ def yyyymmdd(ts: datetime.datetime | None = None) -> str:
     ts = ts or datetime.datetime.utcnow()
     return ts.strftime("%Y%m%d")
 
-def upsert_user(uid: str, source: dict | None = None):
-    profile = fetch_line_profile(uid) or {}
-    doc_ref = get_db().collection("users").document(uid)
-    payload = {
-        "uid": uid,
+# ── 每日用量計數（usage_maps_daily/{YYYYMMDD}，分片計數器） ─────────────────────
+# invocation 內先在記憶體累加，結束時寫入隨機一個 shards/{n}（Increment），
+# 再由 rollupUsage 排程把各分片加總回 usage_maps_daily/{YYYYMMDD}，後台只讀這一份。
+# 指標名稱以 "." 分層，例如 places.nearbysearch.OK、placesCache.memory、replies.ok
+USAGE_SHARDS = int(os.environ.get("USAGE_SHARDS", "10"))
+TW_TZ = datetime.timezone(datetime.timedelta(hours=8))   # 與後台 maps.js 的 Asia/Taipei 日期一致
+
+_usage_buf: Dict[str, int] = {}
+_usage_lock = threading.Lock()
+
+def usage_day(ts: datetime.datetime | None = None) -> str:
+    return (ts or datetime.datetime.now(TW_TZ)).astimezone(TW_TZ).strftime("%Y%m%d")
+
+def usage_incr(metric: str, n: int = 1):
+    with _usage_lock:
+        _usage_buf[metric] = _usage_buf.get(metric, 0) + n
+
+def _nest_metrics(flat: Dict[str, Any], wrap=lambda v: v) -> dict:
+    out: dict = {}
+    for metric, v in flat.items():
+        *path, leaf = metric.split(".")
+        node = out
+        for p in path:
+            node = node.setdefault(p, {})
+        node[leaf] = wrap(v)
+    return out
+
+def flush_usage():
+    """把累加中的計數寫入今天的隨機分片（一次 set(merge)）"""
+    with _usage_lock:
+        pending = dict(_usage_buf)
+        _usage_buf.clear()
+    if not pending:
+        return
+    try:
+        (get_db().collection("usage_maps_daily").document(usage_day())
+            .collection("shards").document(str(random.randrange(USAGE_SHARDS)))
+            .set(_nest_metrics(pending, Increment), merge=True))
+        trace_count("fs.writes")
+    except Exception as e:
+        print("USAGE_EXC", {"metrics": pending, "err": repr(e)})
+
+def _sum_into(dst: dict, src: dict):
+    for k, v in src.items():
+        if isinstance(v, dict):
+            _sum_into(dst.setdefault(k, {}), v)
+        elif isinstance(v, (int, float)):
+            dst[k] = dst.get(k, 0) + v
+
+def rollup_usage(day: str | None = None) -> dict:
+    """加總 usage_maps_daily/{day}/shards/* 寫回 usage_maps_daily/{day}"""
+    day = day or usage_day()
+    day_ref = get_db().collection("usage_maps_daily").document(day)
+    totals: dict = {}
+    for snap in day_ref.collection("shards").stream():
+        _sum_into(totals, snap.to_dict() or {})
+    if totals:
+        day_ref.set({**totals, "rolledUpAt": firestore.SERVER_TIMESTAMP}, merge=True)
+    return totals
+
+# ── 使用者 context（每個事件只讀一次 users/{uid}） ─────────────────────────
+class UserContext:
+    """
+    單一 webhook 事件內的 users/{uid} 快照。
+    事件開始時讀一次文件，之後 session / pref / radius / prefs 都從這裡取，
+    不再各自 get()。
+    """
+
+    def __init__(self, uid: str | None, data: dict | None = None, exists: bool = False):
+        self.uid = uid
+        self.data = data or {}
+        self.exists = exists
+        self._pending: dict = {}          # 待寫入 users/{uid} 的欄位（merge 用）
+        self._messages: Dict[str, list] = {}   # 待寫入的訊息：chunk id → 精簡訊息（見 save_user_message）
+        self.profile_stale = False        # upsert_user 判定 LINE profile 需要重抓
+
+    @classmethod
+    def load(cls, uid: str | None) -> "UserContext":
+        if not uid:
+            return cls(None)
+        with span("user.load"):
+            snap = get_db().collection("users").document(uid).get()
+        trace_count("fs.reads")
+        return cls(uid, snap.to_dict() or {}, bool(snap.exists))
+
+    @property
+    def session(self) -> dict:
+        return self.data.get("session") or {}
+
+    @property
+    def next_step(self) -> str | None:
+        return self.session.get("next")
+
+    @property
+    def session_pref(self) -> str | None:
+        return self.session.get("pref")
+
+    @property
+    def radius(self) -> int | None:
+        return (self.data.get("pref") or {}).get("radius")
+
+    @property
+    def _food_top(self) -> list[tuple[str, float]]:
+        fp = self.data.get("foodPrefs")
+        if isinstance(fp, dict) and isinstance(fp.get("top"), list):
+            return [(e["k"], float(e.get("w") or 0)) for e in fp["top"] if isinstance(e, dict) and e.get("k")]
+        return _legacy_top(self.data.get("prefs"))   # 還沒轉換的舊資料
+
+    @property
+    def prefs(self) -> dict:
+        """食物詞 → 權重（同一份 top-K 共用衰減基準，比例即相對偏好）"""
+        return dict(self._food_top)
+
+    def top_food_prefs(self, k: int = 5) -> list[str]:
+        """最常選的前 k 個偏好（foodPrefs.top 寫入時已排序）"""
+        return [x for x, _ in self._food_top[:k]]
+
+    # ── 寫入緩衝：同一事件的多次 set(merge) 合併成一次 ──
+    def update(self, fields: dict):
+        """暫存一筆 merge 寫入（可含 Increment / ArrayUnion），同時更新本地快照"""
+        _merge_update(self._pending, fields)
+        _apply_local(self.data, fields)
+
+    def add_message(self, chunk_id: str, item: dict):
+        self._messages.setdefault(chunk_id, []).append(item)
+
+    def flush(self):
+        """把暫存的寫入一次送出：只有欄位 → 單次 set(merge)；另有訊息 → 一個 batch（使用者文件 + 訊息 chunk）"""
+        if not self.uid or not (self._pending or self._messages):
+            return
+        uref = get_db().collection("users").document(self.uid)
+        with span("user.flush"):
+            if not self._messages:
+                uref.set(self._pending, merge=True)
+            else:
+                batch = get_db().batch()
+                if self._pending:
+                    batch.set(uref, self._pending, merge=True)
+                for chunk_id, items in self._messages.items():
+                    batch.set(uref.collection(MESSAGE_CHUNK_COLLECTION).document(chunk_id),
+                              _message_chunk_payload(chunk_id, items), merge=True)
+                batch.commit()
+        trace_count("fs.writes", (1 if self._pending else 0) + len(self._messages))
+        self._pending, self._messages = {}, {}
+
+def _merge_update(dst: dict, src: dict) -> dict:
+    """巢狀合併 merge 寫入；同一欄位的 Increment 相加、ArrayUnion 取聯集，其餘後寫覆蓋"""
+    for k, v in src.items():
+        cur = dst.get(k)
+        if isinstance(v, dict) and isinstance(cur, dict):
+            _merge_update(cur, v)
+        elif isinstance(v, Increment) and isinstance(cur, Increment):
+            dst[k] = Increment(cur.value + v.value)
+        elif isinstance(v, Increment) and isinstance(cur, (int, float)) and not isinstance(cur, bool):
+            dst[k] = cur + v.value   # 同一次寫入先設值再累加 → 直接寫總和
+        elif isinstance(v, ArrayUnion) and isinstance(cur, ArrayUnion):
+            dst[k] = ArrayUnion(list(cur.values) + [x for x in v.values if x not in cur.values])
+        else:
+            dst[k] = _merge_update({}, v) if isinstance(v, dict) else v
+    return dst
+
+def _apply_local(dst: dict, src: dict):
+    """把 merge 寫入套到本地快照（讓同一事件後續讀得到剛寫的值）"""
+    for k, v in src.items():
+        cur = dst.get(k)
+        if isinstance(v, dict):
+            if not isinstance(cur, dict):
+                cur = dst[k] = {}
+            _apply_local(cur, v)
+        elif isinstance(v, Increment):
+            dst[k] = (cur if isinstance(cur, (int, float)) else 0) + v.value
+        elif isinstance(v, ArrayUnion):
+            lst = list(cur) if isinstance(cur, list) else []
+            dst[k] = lst + [x for x in v.values if x not in lst]
+        elif v is firestore.DELETE_FIELD:
+            dst.pop(k, None)
+        else:
+            dst[k] = v
+
+def _user_set(uid: str, fields: dict, ctx: UserContext | None = None):
+    """有 ctx 就併入事件緩衝，否則直接 set(merge)"""
+    if ctx is not None:
+        ctx.update(fields)
+    else:
+        get_db().collection("users").document(uid).set(fields, merge=True)
+
+# LINE profile（displayName / pictureUrl / statusMessage）超過這個時間才重抓
+PROFILE_TTL_SEC = int(float(os.environ.get("PROFILE_TTL_HOURS", "24")) * 3600)
+
+def _profile_stale(data: dict) -> bool:
+    try:
+        return time.time() - float(data.get("profileAt")) > PROFILE_TTL_SEC
+    except (TypeError, ValueError):
+        return True
+
+def _profile_fields(uid: str) -> dict:
+    """抓 LINE profile 轉成 users/{uid} 欄位；抓不到回 {}（不覆蓋舊資料）"""
+    profile = fetch_line_profile(uid)
+    if profile is None:
+        return {}
+    return {
         "displayName": profile.get("displayName"),
         "pictureUrl": profile.get("pictureUrl"),
         "statusMessage": profile.get("statusMessage"),
+        "profileAt": int(time.time()),
+    }
+
+def upsert_user(uid: str, source: dict | None = None, ctx: UserContext | None = None):
+    """
+    更新 lastSeenAt / lastSource；LINE profile 只在超過 PROFILE_TTL_SEC 時重抓。
+    有 ctx 時只標記 ctx.profile_stale，實際抓取延到回覆之後（refresh_profile）。
+    """
+    doc_ref = get_db().collection("users").document(uid)
+    payload = {
+        "uid": uid,
         "lastSeenAt": firestore.SERVER_TIMESTAMP,
         "lastSource": source or {},
     }
-    if not doc_ref.get().exists:
+    if ctx is not None:
+        exists = ctx.exists
+        ctx.profile_stale = _profile_stale(ctx.data)
+    else:
+        snap = doc_ref.get()
+        exists = snap.exists
+        if _profile_stale(snap.to_dict() or {}):
+            payload.update(_profile_fields(uid))
+    if not exists:
         payload["firstSeenAt"] = firestore.SERVER_TIMESTAMP
-    doc_ref.set(payload, merge=True)
+    _user_set(uid, payload, ctx)
+
+def refresh_profile(ctx: UserContext):
+    """事件狀態寫入後才呼叫：profile 過期就重抓，另外寫一次 set(merge)"""
+    if not (ctx.uid and ctx.profile_stale):
+        return
+    ctx.profile_stale = False
+    fields = _profile_fields(ctx.uid)
+    if fields:
+        ctx.update(fields)
+        ctx.flush()
+
+# ── 事件日誌（events/{day}/logs）：invocation 內先緩衝，結束時 BulkWriter 一次寫出 ──
+# 文件 ID 是隨機 uuid（本來就分散）；真正的熱點是遞增的 at：單欄位索引關掉（firestore.indexes.json），
+# 改用 (shard, at) 複合索引，寫入分散到 EVENT_LOG_SHARDS 段，依時間查詢時各 shard 分別查再合併；
+# raw event 依 EVENT_LOG_RAW_SAMPLE 的比例完整保留，其餘只存精簡欄位（eventLite）。
+EVENT_LOG_SHARDS     = int(os.environ.get("EVENT_LOG_SHARDS", "16"))
+EVENT_LOG_RAW_SAMPLE = float(os.environ.get("EVENT_LOG_RAW_SAMPLE", "1.0"))
+EVENT_LOG_MAX_BUFFER = 200   # 緩衝超過就先寫出一次
+
+_event_log_buf: list[tuple[str, str, dict]] = []
+_event_log_lock = threading.Lock()
+
+def _project_event(ev: dict) -> dict:
+    """只留分析用得到的欄位"""
+    msg = ev.get("message") or {}
+    src = ev.get("source") or {}
+    out = {
+        "type": ev.get("type"),
+        "timestamp": ev.get("timestamp"),
+        "webhookEventId": ev.get("webhookEventId"),
+        "isRedelivery": (ev.get("deliveryContext") or {}).get("isRedelivery"),
+        "sourceType": src.get("type"),
+    }
+    if msg:
+        out["messageType"] = msg.get("type")
+        if msg.get("type") == "text":
+            out["text"] = (msg.get("text") or "")[:200]
+        elif msg.get("type") == "location":
+            out["latitude"], out["longitude"] = msg.get("latitude"), msg.get("longitude")
+    if ev.get("postback"):
+        out["postback"] = (ev["postback"].get("data") or "")[:300]
+    return {k: v for k, v in out.items() if v is not None}
 
 def log_event(uid: str | None, ev_type: str, raw_event: dict):
-    day = yyyymmdd()
-    get_db().collection("events").document(day).collection("logs").add({
+    """加進緩衝；實際寫入在 flush_event_logs()（webhook 結束時）"""
+    doc = {
         "uid": uid,
         "type": ev_type,
         "at": firestore.SERVER_TIMESTAMP,
-        "event": raw_event
-    })
-
-def save_user_message(uid: str, content: dict):
-    get_db().collection("users").document(uid).collection("messages").add({
-        "at": firestore.SERVER_TIMESTAMP,
-        **content
-    })
-    summary = {}
+        "shard": random.randrange(EVENT_LOG_SHARDS),
+    }
+    if EVENT_LOG_RAW_SAMPLE >= 1 or random.random() < EVENT_LOG_RAW_SAMPLE:
+        doc["event"] = raw_event
+    else:
+        doc["eventLite"] = _project_event(raw_event)
+    with _event_log_lock:
+        _event_log_buf.append((yyyymmdd(), uuid.uuid4().hex[:20], doc))
+        full = len(_event_log_buf) >= EVENT_LOG_MAX_BUFFER
+    if full:
+        flush_event_logs()
+
+def flush_event_logs():
+    """把緩衝中的事件用 BulkWriter 一次寫出（失敗只記 log，不影響回覆）"""
+    with _event_log_lock:
+        pending = _event_log_buf[:]
+        _event_log_buf.clear()
+    if not pending:
+        return
+    try:
+        db = get_db()
+        bw = db.bulk_writer()
+        for day, doc_id, doc in pending:
+            bw.create(db.collection("events").document(day).collection("logs").document(doc_id), doc)
+        bw.close()
+        trace_count("fs.writes", len(pending))
+    except Exception as e:
+        print("EVENT_LOG_EXC", {"n": len(pending), "err": repr(e)})
+
+# ── 對話紀錄：每位使用者每天一份 chunk（陣列有上限），使用者文件留最近 N 則 ──────
+# users/{uid}/message_chunks/{YYYYMMDD-NN}：day, items[≤MESSAGE_CHUNK_MAX], count, expireAt
+# users/{uid}.recentMessages：最近 MESSAGE_RECENT_MAX 則（後台直接讀，不必查子集合）
+# users/{uid}.msgChunk：{day, part, n} 目前寫到哪一份 chunk（從已讀到的使用者文件取得，不另外讀）；
+#   n 決定何時換下一份 chunk，續寫同一份時用 Increment 累加，並行的 invocation 不會少算；
+#   換份 / 換日時才直接設值（同時換份最多讓一份 chunk 超出上限幾則）。
+# recentMessages 是讀出來改完再寫回：同一使用者的事件在同一次 invocation 內依序處理，
+#   只有不同 invocation 同時寫同一人時可能少掉一則（完整紀錄仍在 chunk 裡）。
+# 保留期限由 expireAt 搭配 Firestore TTL policy 執行（MESSAGE_RETENTION_DAYS，0 = 不設期限）；
+# TTL 與 items / recentMessages 不建索引的設定都在 firestore.indexes.json
+MESSAGE_CHUNK_COLLECTION = "message_chunks"
+MESSAGE_CHUNK_MAX        = int(os.environ.get("MESSAGE_CHUNK_MAX", "200"))   # 每則精簡後 ≤ ~2KB，遠低於 1MiB 文件上限
+MESSAGE_RECENT_MAX       = int(os.environ.get("MESSAGE_RECENT_MAX", "20"))
+MESSAGE_RETENTION_DAYS   = int(os.environ.get("MESSAGE_RETENTION_DAYS", "90"))
+MESSAGE_TEXT_MAX         = 500
+
+# 非文字訊息只留這些欄位（不存整個 raw message）
+_MESSAGE_KEEP = ("id", "packageId", "stickerId", "fileName", "fileSize", "duration", "title")
+
+def _compact_message(content: dict) -> dict:
+    """save_user_message 收到的內容 → 精簡格式（陣列元素不能用 SERVER_TIMESTAMP，時間用毫秒）"""
+    item: Dict[str, Any] = {"type": content.get("type"), "at": int(time.time() * 1000)}
+    if content.get("text") is not None:
+        item["text"] = str(content["text"])[:MESSAGE_TEXT_MAX]
+    if content.get("data") is not None:
+        item["data"] = str(content["data"])[:300]
+    if content.get("latitude") is not None:
+        item.update({"lat": content.get("latitude"), "lng": content.get("longitude"),
+                     "address": (content.get("address") or "")[:200]})
+    raw = content.get("raw") or {}
+    item.update({k: raw[k] for k in _MESSAGE_KEEP if raw.get(k) is not None})
+    return {k: v for k, v in item.items() if v is not None}
+
+def _message_chunk_payload(chunk_id: str, items: list[dict]) -> dict:
+    day = chunk_id.split("-", 1)[0]
+    payload = {"day": day, "items": ArrayUnion(items), "count": Increment(len(items))}
+    if MESSAGE_RETENTION_DAYS > 0:
+        d = datetime.datetime.strptime(day, "%Y%m%d").replace(tzinfo=TW_TZ)
+        payload["expireAt"] = d + datetime.timedelta(days=MESSAGE_RETENTION_DAYS + 1)
+    return payload
+
+def save_user_message(uid: str, content: dict, ctx: UserContext | None = None):
+    """
+    記一則對話：加進當天的 chunk、更新 recentMessages / lastMessage。
+    有 ctx 時併入事件結束的那一次寫入；沒有就自己讀一次使用者文件再寫。
+    """
+    own = ctx is None
+    if own:
+        ctx = UserContext.load(uid)
+    item = _compact_message(content)
+
+    day = usage_day()
+    cur = ctx.data.get("msgChunk") or {}
+    part, n = (int(cur.get("part") or 0), int(cur.get("n") or 0)) if cur.get("day") == day else (0, 0)
+    if n >= MESSAGE_CHUNK_MAX:
+        part, n = part + 1, 0
+    ctx.add_message(f"{day}-{part:02d}", item)
+
+    recent = [m for m in (ctx.data.get("recentMessages") or []) if isinstance(m, dict)]
+    summary = {
+        "msgChunk": {"n": Increment(1)} if n else {"day": day, "part": part, "n": 1},
+        "recentMessages": (recent + [item])[-MESSAGE_RECENT_MAX:],
+    }
     if "text" in content:
         summary["lastMessage"] = content["text"][:200]
     if "type" in content:
         summary["lastMessageType"] = content["type"]
-    get_db().collection("users").document(uid).set(summary, merge=True)
+    _user_set(uid, summary, ctx)
+    if own:
+        ctx.flush()
 
-def set_user_radius(uid: str, radius: int):
-    get_db().collection("users").document(uid).set({"pref": {"radius": radius}}, merge=True)
+def set_user_radius(uid: str, radius: int, ctx: UserContext | None = None):
+    _user_set(uid, {"pref": {"radius": radius}}, ctx)
 
 def get_user_radius(uid: str) -> int | None:
-    snap = get_db().collection("users").document(uid).get()
-    if snap.exists:
-        return (snap.to_dict().get("pref") or {}).get("radius")
-    return None
-
-def cards_per_reply() -> int:
-    """讀 settings/replies.cardsPerReply；無則回 5；限制 3~9"""
-    try:
-        snap = get_db().document("settings/replies").get()
-        n = (snap.to_dict() or {}).get("cardsPerReply") if (snap and snap.exists) else 5
-    except Exception:
-        n = 5
-    try:
-        n = int(n)
-    except Exception:
-        n = 5
-    return max(3, min(9, n))
+    return UserContext.load(uid).radius
+
+# ── 食物偏好：有上限、會衰減的 top-K（users/{uid}.foodPrefs） ────────────────────
+# foodPrefs = {"top": [{"k": 食物詞, "w": 衰減後次數}, ...]（依 w 降序，最多 PREF_TOP_K 筆）,
+#              "recent": [最近選的食物詞，新→舊，最多 PREF_RECENT_MAX], "at": 上次更新 ms}
+# 每次記錄先把整張表衰減到現在再 +1，所有 w 共用同一個基準時間，兩次寫入之間順序不變，讀取時不必排序。
+# 表滿時淘汰權重最小的一筆、新口味以 1 進表（舊口味會隨衰減讓位）。
+# prefs_list 只留 top-K 的 key（推播 segment 的 array-contains-any 用）；
+# 舊版無上限的 prefs 字典在第一次記錄時轉進 top-K 並刪除。
+# 取捨：top 是排序好的陣列，沒辦法用 Increment / ArrayUnion，所以是讀出、改完、整份寫回。
+# 同一使用者的事件在同一次 invocation 內依序處理（process_events），只有兩個 invocation
+# 同時替同一人記偏好時，後寫的會蓋掉先寫的那一次 +1；衰減計數本來就是近似值，接受這個誤差。
+PREF_TOP_K = int(os.environ.get("PREF_TOP_K", "20"))
+PREF_RECENT_MAX = int(os.environ.get("PREF_RECENT_MAX", "10"))
+PREF_HALF_LIFE_MS = float(os.environ.get("PREF_HALF_LIFE_DAYS", "30")) * 86400 * 1000
+
+def _legacy_top(prefs: dict) -> list[tuple[str, float]]:
+    """舊版 prefs 字典 → 依次數降序的 [(key, count)]（最多 PREF_TOP_K）"""
+    kv = [(k, float(v)) for k, v in (prefs or {}).items() if k and isinstance(v, (int, float)) and v > 0]
+    return sorted(kv, key=lambda x: x[1], reverse=True)[:PREF_TOP_K]
+
+def record_food_pref(uid: str, food: str, ctx: UserContext | None = None):
+    """將偏好記到 users/{uid}（和同一事件的其他欄位一起寫一次）：
+       - foodPrefs: 衰減計數 top-K + 最近選過的清單（key 取 food_pref_keys()，一句話可能記到多個類別）
+       - prefs_list: top-K 的 key（陣列，依權重降序）"""
+    keys = food_pref_keys(food)
+    if not keys: return
+    own = ctx is None
+    if own:
+        ctx = UserContext.load(uid)
+    now_ms = int(time.time() * 1000)
+    fp = ctx.data.get("foodPrefs")
+    if isinstance(fp, dict) and isinstance(fp.get("top"), list):
+        scale = 0.5 ** (max(0, now_ms - int(fp.get("at") or now_ms)) / PREF_HALF_LIFE_MS)
+        weights = {e["k"]: float(e.get("w") or 0) * scale for e in fp["top"] if isinstance(e, dict) and e.get("k")}
+        recent = [x for x in (fp.get("recent") or []) if isinstance(x, str)]
+    else:
+        weights, recent = dict(_legacy_top(ctx.data.get("prefs"))), []
 
-def record_food_pref(uid: str, food: str):
-    """將偏好記到 users/{uid}：
-       - prefs.{food}: 累計次數（字典）
-       - prefs_list: 近期紀錄（陣列）"""
-    k = norm_food(food)
-    if not k: return
-    db = get_db()
-    uref = db.collection("users").document(uid)
-    uref.set({"prefs": {k: Increment(1)}}, merge=True)
-    uref.set({"prefs_list": ArrayUnion([k]) }, merge=True)
+    for k in keys:
+        if k in weights:
+            weights[k] += 1.0
+        elif len(weights) < PREF_TOP_K:
+            weights[k] = 1.0
+        else:
+            victims = [x for x in weights if x not in keys]   # 同一句的其他類別不互相淘汰
+            if victims:
+                weights.pop(min(victims, key=weights.get))
+                weights[k] = 1.0
+    top = sorted(weights.items(), key=lambda kv: kv[1], reverse=True)[:PREF_TOP_K]
+
+    fields = {
+        "foodPrefs": {
+            "top": [{"k": key, "w": round(w, 4)} for key, w in top],
+            "recent": (keys + [x for x in recent if x not in keys])[:PREF_RECENT_MAX],
+            "at": now_ms,
+        },
+        "prefs_list": [key for key, _ in top],
+    }
+    if "prefs" in ctx.data:
+        fields["prefs"] = firestore.DELETE_FIELD
+    _user_set(uid, fields, ctx)
+    if own:
+        ctx.flush()
 
 def get_top_food_prefs(uid: str, k: int = 5) -> list[str]:
-    """回傳使用者最常選的前 k 個偏好（依字典 prefs 降序）"""
-    snap = get_db().collection("users").document(uid).get()
-    if not snap.exists: return []
-    prefs = (snap.to_dict() or {}).get("prefs", {}) or {}
-    return [x for x,_ in sorted(prefs.items(), key=lambda kv: kv[1], reverse=True)[:k]]
+    """回傳使用者最常選的前 k 個偏好（foodPrefs.top 已排序）"""
+    return UserContext.load(uid).top_food_prefs(k)
 
-def set_next(uid: str, step: str | None):
-    get_db().collection("users").document(uid).set({"session": {"next": step}}, merge=True)
+def set_next(uid: str, step: str | None, ctx: UserContext | None = None):
+    _user_set(uid, {"session": {"next": step}}, ctx)
 
-def set_session_pref(uid: str, pref: str | None):
-    get_db().collection("users").document(uid).set({"session": {"pref": pref}}, merge=True)
+def set_session_pref(uid: str, pref: str | None, ctx: UserContext | None = None):
+    _user_set(uid, {"session": {"pref": pref}}, ctx)
 
 def get_session_pref(uid: str) -> str | None:
-    snap = get_db().collection("users").document(uid).get()
-    return ((snap.to_dict() or {}).get("session") or {}).get("pref")
+    return UserContext.load(uid).session_pref
 
 def get_next(uid: str) -> str | None:
-    snap = get_db().collection("users").document(uid).get()
-    return ((snap.to_dict() or {}).get("session") or {}).get("next")
+    return UserContext.load(uid).next_step
 
 # ===== 食物偏好：字串正規化 =====
 def norm_food(s: str) -> str:
@@ -294,6 +967,242 @@ def norm_food(s: str) -> str:
     x = x.strip(".,!?:;，。！？：；／/\\|*#@（）()[]{}<>「」『』")
     return x
 
+# ── 食物詞正規化：簡→繁、同義詞 / 別名（settings/foods）、Aho-Corasick 一次掃描 ──────
+# 整句就是別名（「牛肉面」「beef noodle」）才換成 canonical（canon_food）；其他句子保留使用者原文
+# 當 session 偏好（= Places 關鍵字與快取 key），「炸雞排」不會被改成「炸雞」。
+# 偏好計數、推播 segment 的 prefs 則用 food_pref_keys()：句中命中的類別（「紅燒牛肉麵」→「牛肉麵」）。
+# 簡→繁只用在比對字形（food_norm），不會改寫回傳給使用者或送去 Places 的文字。
+# settings/foods.synonyms = {"牛肉麵": ["beef noodle", ...]}（canonical → 別名），與內建 FOOD_SYNONYMS 合併。
+# 別名只收同一道食物的不同寫法；更具體的品項（咖哩飯、叉燒飯）不收，留給句中比對分類。
+FOOD_SYNONYMS: Dict[str, list[str]] = {
+    "牛肉麵": ["beef noodle", "beef noodles", "牛肉湯麵"],
+    "拉麵": ["ramen", "日式拉麵"],
+    "咖哩": ["咖喱", "curry"],
+    "滷味": ["魯味"],
+    "滷肉飯": ["魯肉飯", "肉燥飯", "braised pork rice"],
+    "燒臘": ["燒味"],
+    "便當": ["bento", "飯盒"],
+    "火鍋": ["hot pot", "hotpot", "鍋物"],
+    "麻辣燙": ["冒菜"],
+    "壽司": ["sushi"],
+    "燒肉": ["yakiniku", "日式燒肉"],
+    "燒烤": ["bbq", "barbecue", "烤肉", "串燒"],
+    "披薩": ["pizza", "比薩"],
+    "漢堡": ["burger", "hamburger"],
+    "義大利麵": ["pasta", "spaghetti", "意大利麵", "意麵"],
+    "炸雞": ["fried chicken"],
+    "鹽酥雞": ["鹹酥雞"],
+    "牛排": ["steak"],
+    "水餃": ["餃子", "dumpling", "dumplings"],
+    "鍋貼": ["potsticker", "potstickers"],
+    "小籠包": ["xiaolongbao", "湯包"],
+    "早午餐": ["brunch"],
+    "咖啡": ["coffee", "cafe", "咖啡廳"],
+    "甜點": ["dessert", "甜品"],
+    "冰品": ["剉冰", "刨冰", "shaved ice"],
+    "手搖飲": ["飲料"],
+    "素食": ["vegetarian", "vegan", "蔬食"],
+    "臭豆腐": ["stinky tofu"],
+    "蚵仔煎": ["蚵煎", "oyster omelette"],
+    "泰式料理": ["泰國菜", "泰式", "thai food"],
+    "韓式料理": ["韓國料理", "韓式", "korean food"],
+    "日式料理": ["日本料理", "日式", "japanese food"],
+}
+
+# 簡→繁（只收食物 / 餐廳常用字；只用來統一比對字形，不輸出）
+# 一對多的字（团→團/糰、卷→卷/捲）不收，免得比對時湊出不存在的詞
+_S2T = str.maketrans(
+    "面饭汤烧腊卤鱼虾饺馄饨鸭鸡猪锅炖饼酱凤点咸烩热冻肠丝杂荞乌寿麦鹅蚝贝圆汉条脚炉双鲜鲁饮馆厅盐葱姜鸳鸯贴馒头卖云湾广东粤兰凉馅烫义萨类韩铁轻",
+    "麵飯湯燒臘滷魚蝦餃餛飩鴨雞豬鍋燉餅醬鳳點鹹燴熱凍腸絲雜蕎烏壽麥鵝蠔貝圓漢條腳爐雙鮮魯飲館廳鹽蔥薑鴛鴦貼饅頭賣雲灣廣東粵蘭涼餡燙義薩類韓鐵輕",
+)
+
+def food_norm(s: str) -> str:
+    """norm_food + 簡體字轉繁體（比對、索引用的字形）"""
+    return norm_food(s).translate(_S2T)
+
+class FoodMatcher:
+    """
+    Aho-Corasick：所有別名（含 canonical 本身）編成一棵 trie + fail link，
+    一次掃描找出文字裡出現的所有食物詞，取最左、最長、不重疊的命中。
+    """
+    def __init__(self, synonyms: Dict[str, list[str]]):
+        self.exact: Dict[str, str] = {}
+        for canon, aliases in synonyms.items():
+            c = food_norm(canon)
+            if not c:
+                continue
+            for alias in [canon, *(aliases or [])]:
+                a = food_norm(str(alias))
+                if a:
+                    self.exact.setdefault(a, c)
+
+        self._goto: list[Dict[str, int]] = [{}]
+        self._out: list[list[tuple[int, str]]] = [[]]   # 節點 → [(別名長度, canonical)]
+        for alias, canon in self.exact.items():
+            node = 0
+            for ch in alias:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[node][ch] = nxt
+                    self._goto.append({})
+                    self._out.append([])
+                node = nxt
+            self._out[node].append((len(alias), canon))
+
+        # BFS 建 fail link，並把 fail 節點的輸出併進來
+        self._fail = [0] * len(self._goto)
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for ch, nxt in self._goto[node].items():
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+                queue.append(nxt)
+
+    def find(self, text: str) -> list[tuple[int, int, str]]:
+        """回傳 [(start, end, canonical)]：最左優先、同起點取最長、彼此不重疊"""
+        hits = []
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for n, canon in self._out[node]:
+                hits.append((i + 1 - n, i + 1, canon))
+        hits.sort(key=lambda h: (h[0], h[0] - h[1]))
+        out, end = [], 0
+        for h in hits:
+            if h[0] >= end:
+                out.append(h)
+                end = h[1]
+        return out
+
+_food_matchers: Dict[str, FoodMatcher] = {}
+
+def food_matcher() -> FoodMatcher:
+    """目前 settings/foods 版本的比對器；字典改了就重建"""
+    try:
+        version = get_settings()["foodsVersion"]
+        custom = get_settings()["foods"].get("synonyms") or {}
+    except Exception:
+        version, custom = "", {}
+    m = _food_matchers.get(version)
+    if m is None:
+        merged = {k: list(v) for k, v in FOOD_SYNONYMS.items()}
+        for canon, aliases in custom.items():
+            if isinstance(canon, str) and isinstance(aliases, list):
+                merged.setdefault(canon, []).extend(str(a) for a in aliases)
+        m = FoodMatcher(merged)
+        _food_matchers.clear()
+        _food_matchers[version] = m
+        _place_cats.clear()   # 店家類別是用舊字典算的
+    return m
+
+def food_terms(s: str) -> list[str]:
+    """文字裡出現的所有食物類別（canonical，依出現順序、不重複）"""
+    return list(dict.fromkeys(canon for _, _, canon in food_matcher().find(food_norm(s))))
+
+def canon_food(s: str) -> str:
+    """
+    自由文字 → 偏好詞：整句是別名才換成 canonical，否則回傳正規化後的原文
+    （不做簡→繁、不截成句中的食物詞）。
+    """
+    t = norm_food(s)
+    if not t:
+        return ""
+    return food_matcher().exact.get(food_norm(t)) or t
+
+def food_pref_keys(s: str) -> list[str]:
+    """
+    偏好計數用的 key：整句是別名 → [canonical]；否則句中出現的所有食物類別；
+    一個都沒有就是正規化後的原文（沒收錄的食物照舊當偏好）。
+    """
+    t = norm_food(s)
+    if not t:
+        return []
+    hit = food_matcher().exact.get(food_norm(t))
+    if hit:
+        return [hit]
+    return food_terms(t) or [t]
+
+# ── 通用 LRU + TTL 快取（執行緒安全，單一 instance 內共用） ───────────────────
+class TTLCache:
+    def __init__(self, maxsize: int = 256, ttl_sec: float = 60):
+        self.maxsize = maxsize
+        self.ttl_sec = ttl_sec
+        self._data: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return default
+            if hit[0] <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return hit[1]
+
+    def get_many(self, keys: list, default=None) -> list:
+        """一次查多個 key（只拿一次鎖，給整批候選店家用）"""
+        now = time.time()
+        out = []
+        with self._lock:
+            for key in keys:
+                hit = self._data.get(key)
+                if hit is None or hit[0] <= now:
+                    out.append(default)
+                    continue
+                self._data.move_to_end(key)
+                out.append(hit[1])
+        return out
+
+    def set(self, key: str, value, ttl_sec: float | None = None):
+        exp = time.time() + (self.ttl_sec if ttl_sec is None else ttl_sec)
+        with self._lock:
+            self._data[key] = (exp, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# ── Single-flight：同一個 key 同時只跑一次，其餘呼叫等它的結果 ─────────────────
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+
+    def do(self, key: str, fn) -> tuple[Any, bool]:
+        """回傳 (結果, 是否共用了別人的呼叫)；fn 丟出的例外也會傳給所有等待者"""
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._calls[key] = Future()
+        if not leader:
+            return fut.result(), True
+        try:
+            result = fn()
+            fut.set_result(result)
+            return result, False
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
 # ── Quick Replies / Flex ───────────────────────────────────────────────────
 def quick_reply_radius():
     def item(label, r):
@@ -324,62 +1233,152 @@ def build_nearby_url(lat: float, lng: float, keyword: str = "餐廳") -> str:
     q = urlquote(f"{keyword} near {lat},{lng}", safe="")
     return f"https://www.google.com/maps/search/?api=1&query={q}"
 
-def build_flex_carousel(items: list[dict], user_lat: float | None = None, user_lng: float | None = None, liff_slot_url: str | None = None) -> dict:
+# ── Flex 樣板：依 theme 版本編譯一次，每張卡只填店家欄位；序列化結果直接快取成 bytes ──
+FLEX_CACHE_TTL_SEC = int(os.environ.get("FLEX_CACHE_TTL_SEC", "600"))
+FLEX_CACHE_MAX     = int(os.environ.get("FLEX_CACHE_MAX", "1024"))
+FLEX_DEFAULT_IMAGE = "https://i.imgur.com/2JY3Szn.png"
+
+class RawJSON(bytes):
+    """已序列化好的 JSON 片段；json_bytes() 會原樣嵌入，不再序列化"""
+
+_RAW_NONCE = uuid.uuid4().hex[:8]   # 讓使用者輸入的字串不可能剛好等於佔位符
+_RAW_MARK = re.compile(rb'"\\u0000raw' + _RAW_NONCE.encode() + rb':(\d+)\\u0000"')
+_SLOT_MARK = re.compile(r'"\\u0000slot:(\w+)\\u0000"')
+
+def json_bytes(obj) -> bytes:
+    """json 序列化（緊湊、UTF-8），其中的 RawJSON 片段直接拼接"""
+    raws: list[bytes] = []
+
+    def swap(o):
+        if isinstance(o, RawJSON):
+            raws.append(o)
+            return f"\x00raw{_RAW_NONCE}:{len(raws) - 1}\x00"
+        if isinstance(o, dict):
+            return {k: swap(v) for k, v in o.items()}
+        if isinstance(o, (list, tuple)):
+            return [swap(v) for v in o]
+        return o
+
+    out = json.dumps(swap(obj), ensure_ascii=False, separators=(",", ":")).encode()
+    if not raws:
+        return out
+    return _RAW_MARK.sub(lambda m: raws[int(m.group(1))], out)
+
+def _slot(name: str) -> str:
+    return f"\x00slot:{name}\x00"
+
+class FlexTemplate:
     """
-    items 需要至少包含：
-      - title / name（店名）
-      - address（可選，用於 subtitle）
-      - photo（可選，無則 fallback）
-      - lat, lng（地圖/周邊）
-      - mapUrl（可選，若無則用 lat/lng 組）
-    回傳可直接丟給 LINE 的 Flex Carousel 結構。
+    一個 theme 版本的卡片樣板。樣式正規化（_aspect_ratio / _aspect_mode / _gap）只做一次；
+    卡片骨架先序列化成字串片段，render 時只把店家欄位 json.dumps 後插進去。
     """
-    theme     = get_theme()
-    btn_style = "primary" if theme.get("btnKind") == "primary" else "secondary"
-    btn_color = theme.get("btnColor") or "#00B900"
-    spacing   = _gap(theme.get("btnMargin"))
-    aspect    = _aspect_ratio(theme.get("heroRatio"))
-    mode      = _aspect_mode(theme.get("heroMode"))
-    fallback  = theme.get("fallbackImageUrl") or "https://i.imgur.com/2JY3Szn.png"
-
-    bubbles = []
-    for it in items:
-        photo   = it.get("photo") or fallback
-        lat     = it.get("lat"); lng = it.get("lng")
-        map_url = it.get("mapUrl") or (build_gmaps_url(lat, lng) if lat and lng else None)
-        near_url= build_nearby_url(lat, lng, "餐廳") if (lat and lng) else None
 
+    def __init__(self, theme: dict, version: str):
+        self.theme = theme
+        self.version = version
+        self.btn_style = "primary" if theme.get("btnKind") == "primary" else "secondary"
+        self.btn_color = theme.get("btnColor") or "#00B900"
+        self.spacing   = _gap(theme.get("btnMargin"))
+        self.aspect    = _aspect_ratio(theme.get("heroRatio"))
+        self.mode      = _aspect_mode(theme.get("heroMode"))
+        self.fallback  = theme.get("fallbackImageUrl") or FLEX_DEFAULT_IMAGE
+        self._parts: Dict[tuple, list] = {}   # (有地址, 有地圖, 有周邊) → 片段
+        self._lock = threading.Lock()
+
+    def _button(self, label: str, slot: str) -> dict:
+        return {"type":"button","style":self.btn_style,"height":"sm","color":self.btn_color,
+                "action":{"type":"uri","label":label,"uri": _slot(slot)}}
+
+    def _skeleton(self, has_addr: bool, has_map: bool, has_near: bool) -> dict:
         footer_buttons = []
-        if map_url:
-            footer_buttons.append({
-                "type":"button","style":btn_style,"height":"sm","color":btn_color,
-                "action":{"type":"uri","label":"開啟 Google 地圖","uri": map_url}
-            })
-        if near_url:
-            footer_buttons.append({
-                "type":"button","style":btn_style,"height":"sm","color":btn_color,
-                "action":{"type":"uri","label":"查看周邊","uri": near_url}
-            })
-
-        bubbles.append({
+        if has_map:
+            footer_buttons.append(self._button("開啟 Google 地圖", "map"))
+        if has_near:
+            footer_buttons.append(self._button("查看周邊", "near"))
+        return {
             "type":"bubble",
             "hero":{
-                "type":"image","url":photo,"size":"full",
-                "aspectRatio":aspect,"aspectMode":mode
+                "type":"image","url":_slot("photo"),"size":"full",
+                "aspectRatio":self.aspect,"aspectMode":self.mode
             },
             "body":{
                 "type":"box","layout":"vertical","spacing":"sm","contents":[
-                    {"type":"text","text": it.get("title") or it.get("name") or "店名",
+                    {"type":"text","text": _slot("title"),
                      "weight":"bold","size":"md","wrap":True},
-                    *([{"type":"text","text": it.get("address") or it.get("subtitle") or "",
-                        "size":"xs","color":"#8D8D8D","wrap":True}] if (it.get("address") or it.get("subtitle")) else [])
+                    *([{"type":"text","text": _slot("addr"),
+                        "size":"xs","color":"#8D8D8D","wrap":True}] if has_addr else [])
                 ]
             },
             "footer":{
-                "type":"box","layout":"vertical","spacing":spacing,
+                "type":"box","layout":"vertical","spacing":self.spacing,
                 "contents":footer_buttons,"flex":0
             }
-        })
+        }
+
+    def _compiled(self, key: tuple) -> list:
+        parts = self._parts.get(key)
+        if parts is None:
+            raw = json.dumps(self._skeleton(*key), ensure_ascii=False, separators=(",", ":"))
+            parts = _SLOT_MARK.split(raw)   # [字面, 欄位名, 字面, 欄位名, ..., 字面]
+            with self._lock:
+                self._parts[key] = parts
+        return parts
+
+    def render(self, it: dict) -> RawJSON:
+        """一個店家 → 一張 bubble 的 JSON bytes"""
+        lat, lng = it.get("lat"), it.get("lng")
+        values = {
+            "photo": it.get("photo") or self.fallback,
+            "title": it.get("title") or it.get("name") or "店名",
+            "addr":  it.get("address") or it.get("subtitle") or "",
+            "map":   it.get("mapUrl") or (build_gmaps_url(lat, lng) if lat and lng else None),
+            "near":  build_nearby_url(lat, lng, "餐廳") if (lat and lng) else None,
+        }
+        parts = self._compiled((bool(values["addr"]), bool(values["map"]), bool(values["near"])))
+        out = [parts[0]]
+        for i in range(1, len(parts), 2):
+            out.append(json.dumps(values[parts[i]], ensure_ascii=False))
+            out.append(parts[i + 1])
+        return RawJSON("".join(out).encode())
+
+_flex_templates: Dict[str, FlexTemplate] = {}
+_flex_bubbles = TTLCache(FLEX_CACHE_MAX, FLEX_CACHE_TTL_SEC)
+
+def flex_template() -> FlexTemplate:
+    """目前 theme 版本的樣板；theme 改了就換新的（舊版本的卡片快取自然不再命中）"""
+    version = get_theme_version()
+    tpl = _flex_templates.get(version)
+    if tpl is None:
+        tpl = FlexTemplate(get_theme(), version)
+        _flex_templates.clear()
+        _flex_templates[version] = tpl
+    return tpl
+
+def build_flex_carousel(items: list[dict], user_lat: float | None = None, user_lng: float | None = None, liff_slot_url: str | None = None) -> dict:
+    """
+    items 需要至少包含：
+      - title / name（店名）
+      - address（可選，用於 subtitle）
+      - photo（可選，無則 fallback）
+      - lat, lng（地圖/周邊）
+      - mapUrl（可選，若無則用 lat/lng 組）
+    回傳可直接丟給 LINE 的 Flex Carousel 結構；每張 bubble 是 RawJSON，
+    以 (theme 版本, placeId) 快取，送出時用 json_bytes() 序列化。
+    """
+    tpl = flex_template()
+    bubbles = []
+    for it in items:
+        pid = it.get("placeId")
+        key = f"{tpl.version}|{pid}" if pid else None
+        bubble = _flex_bubbles.get(key) if key else None
+        if bubble is None:
+            bubble = tpl.render(it)
+            if key:
+                _flex_bubbles.set(key, bubble)
+            trace_count("flex.render")
+        else:
+            trace_count("flex.cached")
+        bubbles.append(bubble)
 
     return {"type": "carousel", "contents": bubbles}
 
@@ -407,10 +1406,11 @@ def _haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
     c = 2 * asin(sqrt(a))
     return R * c
 
-def _transform_place_item(p: dict, user_lat: float, user_lng: float) -> dict:
+def _transform_place_item(p: dict, user_lat: float, user_lng: float, with_dist: bool = True) -> dict:
     """
     把 Google Places 回傳的單筆 result 轉成我們 Flex 需要的結構：
     name/lat/lng/rating/total/vicinity/photo/mapUrl/distKm...
+    with_dist=False 時不逐筆算距離（交給 rank_places 整批計算）。
     """
     loc = ((p.get("geometry") or {}).get("location") or {})
     lat = loc.get("lat")
@@ -426,7 +1426,10 @@ def _transform_place_item(p: dict, user_lat: float, user_lng: float) -> dict:
     photos = p.get("photos") or []
     if photos:
         ref = photos[0].get("photo_reference")
-        if ref and PLACES_KEY:
+        # 有設圖片代理就走 /photo（網址不含 key，圖只抓一次）；代理簽不出網址時寧可不放圖，
+        # 也不退回帶 key 的 Photo API 網址
+        photo_url = photo_proxy_url("p", ref, 800) if ref else None
+        if ref and not photo_url and not PHOTO_PROXY_BASE and PLACES_KEY:
             # 用 Photo API 生成圖片 URL；LINE 端載入時才會打到 Google
             photo_url = (
                 "https://maps.googleapis.com/maps/api/place/photo"
@@ -436,7 +1439,7 @@ def _transform_place_item(p: dict, user_lat: float, user_lng: float) -> dict:
     # 距離（公里，四捨五入到 2 位）
     dist_km = None
     try:
-        if isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
+        if with_dist and isinstance(lat, (int, float)) and isinstance(lng, (int, float)):
             dist_km = round(_haversine_km(user_lat, user_lng, float(lat), float(lng)), 2)
     except Exception:
         dist_km = None
@@ -454,15 +1457,116 @@ def _transform_place_item(p: dict, user_lat: float, user_lng: float) -> dict:
         "distKm": dist_km,
     }
 
+# ── Places 結果快取（geohash 格 + 半徑 + 查詢參數） ──────────────────────────
+# 同一格內、同樣條件的查詢共用原始 results；distKm 之後依各使用者座標重算
+PLACES_CACHE_PRECISION = int(os.environ.get("PLACES_CACHE_PRECISION", "7"))   # geohash 7 ≈ 150m 見方
+PLACES_CACHE_TTL_SEC   = int(os.environ.get("PLACES_CACHE_TTL_SEC", "600"))
+PLACES_CACHE_MAX       = int(os.environ.get("PLACES_CACHE_MAX", "512"))
+PLACES_CACHE_SHARED    = os.environ.get("PLACES_CACHE_SHARED", "") == "1"      # 另存 Firestore places_cache 跨 instance 共用
+PLACES_CACHE_COLLECTION = "places_cache"
+
+_places_cache = TTLCache(PLACES_CACHE_MAX, PLACES_CACHE_TTL_SEC)
+# 同一個 key 同時 miss 時只查一次（共用快取 + Places），其餘呼叫等結果（午餐尖峰同一棟樓的使用者）
+_places_flight = SingleFlight()
+
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(lat: float, lng: float, precision: int = 7) -> str:
+    lat_rng, lng_rng = [-90.0, 90.0], [-180.0, 180.0]
+    out, bits, ch, even = [], 0, 0, True
+    while len(out) < precision:
+        rng, v = (lng_rng, lng) if even else (lat_rng, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if v >= mid:
+            ch = (ch << 1) | 1
+            rng[0] = mid
+        else:
+            ch = ch << 1
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            out.append(_GEOHASH_BASE32[ch])
+            bits, ch = 0, 0
+    return "".join(out)
+
+def places_cache_key(kind: str, lat: float, lng: float, radius: int, **params) -> str:
+    """例：nearby|wsqqq6u|800|keyword=拉麵|opennow=True|types=restaurant"""
+    cell = geohash_encode(float(lat), float(lng), PLACES_CACHE_PRECISION)
+    parts = [kind, cell, str(int(radius))]
+    parts += [f"{k}={params[k]}" for k in sorted(params) if params[k] not in (None, "", False)]
+    return "|".join(parts)
+
+def _places_cached(key: str, fetch) -> list[dict]:
+    """
+    先查記憶體 LRU，再查 Firestore（若開啟 PLACES_CACHE_SHARED），都沒有才呼叫 fetch()。
+    同一個 key 並行 miss 時只有一個呼叫真的去查，其餘等它並共用結果。
+    只快取 status=OK / ZERO_RESULTS 的回應。
+    """
+    hit = _places_cache.get(key)
+    if hit is not None:
+        usage_incr("placesCache.memory")
+        trace_count("placesCache.memory")
+        return hit
+
+    results, shared = _places_flight.do(key, lambda: _places_load(key, fetch))
+    if shared:
+        usage_incr("placesCache.coalesced")
+        trace_count("placesCache.coalesced")
+    return results
+
+def _places_load(key: str, fetch) -> list[dict]:
+    """_places_cached 的 miss 路徑（同一個 key 同時只會有一個在跑）"""
+    doc_ref = None
+    if PLACES_CACHE_SHARED:
+        try:
+            doc_ref = get_db().collection(PLACES_CACHE_COLLECTION).document(
+                hashlib.sha1(key.encode()).hexdigest())
+            snap = doc_ref.get()
+            trace_count("fs.reads")
+            d = snap.to_dict() or {}
+            left = float(d.get("exp") or 0) - time.time()
+            if snap.exists and left > 0:
+                results = d.get("results") or []
+                _places_cache.set(key, results, left)
+                usage_incr("placesCache.shared")
+                trace_count("placesCache.shared")
+                return results
+        except Exception as e:
+            print("PLACES_CACHE_EXC", repr(e))
+
+    usage_incr("placesCache.miss")
+    trace_count("placesCache.miss")
+    data = fetch()
+    results = data.get("results") or []
+    if data.get("status") in ("OK", "ZERO_RESULTS"):
+        _places_cache.set(key, results)
+        if doc_ref is not None:
+            exp = time.time() + PLACES_CACHE_TTL_SEC
+            try:
+                doc_ref.set({
+                    "key": key,
+                    "results": results,
+                    "exp": exp,
+                    # 給 Firestore TTL policy 用的欄位（firestore.indexes.json 的 places_cache.expireAt）
+                    "expireAt": datetime.datetime.fromtimestamp(exp, datetime.timezone.utc),
+                })
+                trace_count("fs.writes")
+            except Exception as e:
+                print("PLACES_CACHE_EXC", repr(e))
+    return results
+
 # ── 偵錯 ──────────────────────────────────────────────
 def _places_call(url: str, params: dict):
     # 不把 key 打在 log
     safe = {k: v for k, v in params.items() if k != "key"}
-    r = httpx.get(url, params=params, timeout=10.0)
+    r = http_request("places", "GET", url, params=params)
     data = r.json()
     print("PLACES", {"url": url.split("/")[-1], "status": data.get("status"),
                      "error": data.get("error_message"), "params": safe})
+    usage_incr(f"places.{url.split('/')[-2]}.{data.get('status') or f'HTTP_{r.status_code}'}")
     r.raise_for_status()
+    place_index_add(data.get("results") or [], params)
     return data
 
 def _nearby_once(lat: float, lng: float, radius: int, types: str, opennow: bool, limit: int, keyword: str | None = None):
@@ -477,8 +1581,10 @@ def _nearby_once(lat: float, lng: float, radius: int, types: str, opennow: bool,
         params["opennow"] = "true"
     if keyword:
         params["keyword"] = keyword
-    data = _places_call("https://maps.googleapis.com/maps/api/place/nearbysearch/json", params)
-    return (data.get("results") or [])[:limit]
+    key = places_cache_key("nearby", lat, lng, radius, types=types, keyword=keyword, opennow=opennow)
+    results = _places_cached(key, lambda: _places_call(
+        f"{PLACES_API_BASE}/maps/api/place/nearbysearch/json", params))
+    return results[:limit]
 
 def _textsearch_once(lat: float, lng: float, radius: int, query: str, opennow: bool, limit: int):
     params = {
@@ -491,10 +1597,395 @@ def _textsearch_once(lat: float, lng: float, radius: int, query: str, opennow: b
     }
     if opennow:
         params["opennow"] = "true"
-    data = _places_call("https://maps.googleapis.com/maps/api/place/textsearch/json", params)
-    return (data.get("results") or [])[:limit]
+    key = places_cache_key("text", lat, lng, radius, query=query, opennow=opennow)
+    results = _places_cached(key, lambda: _places_call(
+        f"{PLACES_API_BASE}/maps/api/place/textsearch/json", params))
+    return results[:limit]
+
+# ── 本地店家索引（place_index/{geohash6}）：每次 Places 回應都餵進來，常去的區域不必再打 Places ──
+# 每個 geohash 格一份文件，places.{placeId} = 精簡紀錄：
+#   name, lat, lng, rating, total, vicinity, photoRef, types,
+#   kw（曾以哪些關鍵字查到）, seenMs（最後一次出現在回應）, openMs（最後一次出現在 opennow 回應）
+# 查詢時把半徑 R 涵蓋的格子載進記憶體（TTLCache，定期重讀以看到其他 instance 的資料），逐筆比對；
+# 夠新且符合的店 ≥ PLACE_INDEX_MIN_RESULTS 才直接使用，否則照舊呼叫 Places。
+# opennow 查詢只收 PLACE_INDEX_OPEN_TTL_SEC 內看過「營業中」的店（索引沒有營業時間）。
+PLACE_INDEX_ENABLED      = os.environ.get("PLACE_INDEX", "") == "1"
+PLACE_INDEX_PRECISION    = int(os.environ.get("PLACE_INDEX_PRECISION", "6"))       # geohash 6 ≈ 1.2km × 0.6km
+PLACE_INDEX_MIN_RESULTS  = int(os.environ.get("PLACE_INDEX_MIN_RESULTS", "9"))
+PLACE_INDEX_MAX_AGE_SEC  = int(float(os.environ.get("PLACE_INDEX_MAX_AGE_DAYS", "14")) * 86400)
+PLACE_INDEX_OPEN_TTL_SEC = int(os.environ.get("PLACE_INDEX_OPEN_TTL_SEC", "1800"))
+PLACE_INDEX_RELOAD_SEC   = int(os.environ.get("PLACE_INDEX_RELOAD_SEC", "600"))
+PLACE_INDEX_CELLS_MAX    = int(os.environ.get("PLACE_INDEX_CELLS_MAX", "2048"))
+PLACE_INDEX_KW_MAX       = 20
+PLACE_INDEX_COLLECTION   = "place_index"
+_GENERIC_QUERY_TERMS = {"餐廳", "小吃", "早午餐"}
+
+_place_cells = TTLCache(PLACE_INDEX_CELLS_MAX, PLACE_INDEX_RELOAD_SEC)   # cell → {"places", "loaded", "rows"}
+_place_dirty: Dict[str, Dict[str, Any]] = {}                              # 尚未寫回 Firestore 的紀錄
+_place_index_lock = threading.Lock()
+
+def geohash_cells(lat: float, lng: float, radius_m: float, precision: int) -> list[str]:
+    """涵蓋以 (lat, lng) 為圓心、半徑 radius_m 的外接矩形的所有 geohash 格"""
+    bits = 5 * precision
+    cell_h, cell_w = 180.0 / (1 << (bits // 2)), 360.0 / (1 << ((bits + 1) // 2))
+    dlat = radius_m / 111320.0
+    dlng = radius_m / (111320.0 * max(0.01, cos(radians(lat))))
+    cells = set()
+    la = lat - dlat
+    while True:
+        lo = lng - dlng
+        while True:
+            cells.add(geohash_encode(min(la, lat + dlat), min(lo, lng + dlng), precision))
+            if lo >= lng + dlng:
+                break
+            lo += cell_w
+        if la >= lat + dlat:
+            break
+        la += cell_h
+    return sorted(cells)
+
+def _query_terms(q: str) -> list[str]:
+    """「拉麵 餐廳」「餐廳|小吃|早午餐」→ 去掉通用詞後的關鍵字（空 = 不限）"""
+    terms = (food_norm(canon_food(t)) for t in re.split(r"[|\s]+", q or ""))   # 索引文字是 food_norm 字形
+    return [t for t in terms if t and t not in _GENERIC_QUERY_TERMS]
+
+def _index_record(p: dict, now_ms: int) -> tuple[str, dict] | None:
+    loc = ((p.get("geometry") or {}).get("location") or {})
+    lat, lng, pid = loc.get("lat"), loc.get("lng"), p.get("place_id")
+    if not pid or not isinstance(lat, (int, float)) or not isinstance(lng, (int, float)):
+        return None
+    photos = p.get("photos") or []
+    return pid, {
+        "name": p.get("name") or "",
+        "lat": float(lat),
+        "lng": float(lng),
+        "rating": p.get("rating"),
+        "total": p.get("user_ratings_total") or 0,
+        "vicinity": p.get("vicinity") or p.get("formatted_address") or "",
+        "photoRef": photos[0].get("photo_reference") if photos else None,
+        "types": p.get("types") or [],
+        "seenMs": now_ms,
+    }
+
+def _index_to_place(pid: str, rec: dict) -> dict:
+    """轉回 Places result 的形狀，後面照舊走 _transform_place_item"""
+    return {
+        "place_id": pid,
+        "name": rec.get("name"),
+        "geometry": {"location": {"lat": rec.get("lat"), "lng": rec.get("lng")}},
+        "rating": rec.get("rating"),
+        "user_ratings_total": rec.get("total") or 0,
+        "vicinity": rec.get("vicinity") or "",
+        "photos": [{"photo_reference": rec["photoRef"]}] if rec.get("photoRef") else [],
+        "types": rec.get("types") or [],
+    }
+
+def place_index_add(results: list[dict], params: dict):
+    """把一次 Places 回應併進索引（記憶體立即生效，Firestore 在 flush_place_index() 寫回）"""
+    if not PLACE_INDEX_ENABLED or not results:
+        return
+    now_ms = int(time.time() * 1000)
+    terms = _query_terms(params.get("keyword") or params.get("query") or "")
+    opennow = params.get("opennow") == "true"
+    with _place_index_lock:
+        for p in results:
+            hit = _index_record(p, now_ms)
+            if hit is None:
+                continue
+            pid, rec = hit
+            cell = geohash_encode(rec["lat"], rec["lng"], PLACE_INDEX_PRECISION)
+            bucket = _place_cells.get(cell)
+            if bucket is None:
+                # 還沒從 Firestore 載入的格子：先放這次的資料，查詢時再合併
+                bucket = {"places": {}, "loaded": False, "rows": None}
+                _place_cells.set(cell, bucket)
+            old = bucket["places"].get(pid) or {}
+            rec["kw"] = list(dict.fromkeys((old.get("kw") or []) + terms))[-PLACE_INDEX_KW_MAX:]
+            rec["openMs"] = now_ms if opennow else old.get("openMs")
+            bucket["places"][pid] = rec
+            bucket["rows"] = None
+            _place_dirty.setdefault(cell, {})[pid] = rec
+
+def _place_buckets(cells: list[str]) -> list[dict]:
+    """取得格子（缺的一次 get_all 載入，和記憶體中較新的紀錄合併）"""
+    out, missing = [], []
+    for c in cells:
+        b = _place_cells.get(c)
+        if b is not None and b["loaded"]:
+            out.append(b)
+        else:
+            missing.append(c)
+    if not missing:
+        return out
+
+    stored: Dict[str, dict] | None = None
+    try:
+        db = get_db()
+        snaps = db.get_all([db.collection(PLACE_INDEX_COLLECTION).document(c) for c in missing])
+        stored = {s.id: (s.to_dict() or {}).get("places") or {} for s in snaps if s.exists}
+        trace_count("fs.reads", len(missing))
+    except Exception as e:
+        print("PLACE_INDEX_EXC", repr(e))
+
+    with _place_index_lock:
+        for c in missing:
+            b = _place_cells.get(c) or {"places": {}, "loaded": False, "rows": None}
+            if stored is not None:
+                merged = dict(stored.get(c) or {})
+                for pid, rec in b["places"].items():
+                    if rec.get("seenMs", 0) >= (merged.get(pid) or {}).get("seenMs", 0):
+                        merged[pid] = rec
+                b = {"places": merged, "loaded": True, "rows": None}
+                _place_cells.set(c, b)
+            out.append(b)
+    return out
+
+def _bucket_rows(b: dict) -> list[tuple]:
+    """格子內紀錄攤平成比對用的 tuple（店名正規化、kw 串好），格子有變動才重建；呼叫端持有鎖"""
+    if b["rows"] is None:
+        b["rows"] = [
+            (rec["lat"], rec["lng"], rec.get("seenMs", 0), rec.get("openMs") or 0,
+             set(rec.get("types") or ()), "\n".join([food_norm(rec.get("name") or ""), *food_terms(rec.get("name") or ""), *(rec.get("kw") or [])]), pid)
+            for pid, rec in b["places"].items()
+        ]
+    return b["rows"]
+
+def place_index_lookup(lat: float, lng: float, radius: int, kind: str, p: dict, limit: int) -> list[dict] | None:
+    """
+    索引夠新、夠密時回傳 Places 格式的 results（依距離排序），否則回 None 交給 Places。
+    比對：距離 ≤ radius、seenMs 未過期、opennow 時 openMs 夠新、
+    nearby 的 type 有交集（紀錄沒有 types 時不限）、每個關鍵字出現在店名或 kw。
+    """
+    if not PLACE_INDEX_ENABLED:
+        return None
+    now_ms = int(time.time() * 1000)
+    min_seen = now_ms - PLACE_INDEX_MAX_AGE_SEC * 1000
+    min_open = now_ms - PLACE_INDEX_OPEN_TTL_SEC * 1000 if p.get("opennow") else 0
+    terms = _query_terms(p.get("keyword") or p.get("query") or "")
+    types = {t for t in (p.get("types") or "").split("|") if t} if kind == "nearby" else set()
+    r_km = radius / 1000.0
+    dlat = radius / 111320.0
+    dlng = radius / (111320.0 * max(0.01, cos(radians(lat))))
+
+    buckets = _place_buckets(geohash_cells(lat, lng, radius, PLACE_INDEX_PRECISION))
+    found = []
+    with _place_index_lock:
+        for b in buckets:
+            for plat, plng, seen, opened, ptypes, text, pid in _bucket_rows(b):
+                # 先用外接矩形篩，剩下的才算 haversine
+                if abs(plat - lat) > dlat or abs(plng - lng) > dlng:
+                    continue
+                if seen < min_seen or opened < min_open:
+                    continue
+                if types and ptypes and not (types & ptypes):
+                    continue
+                if terms and not all(t in text for t in terms):
+                    continue
+                d = _haversine_km(lat, lng, plat, plng)
+                if d <= r_km:
+                    found.append((d, pid, b["places"][pid]))
+
+    if len(found) < PLACE_INDEX_MIN_RESULTS:
+        trace_count("placeIndex.sparse")
+        return None
+    found.sort(key=lambda x: x[0])
+    usage_incr("placeIndex.hit")
+    trace_count("placeIndex.hit")
+    return [_index_to_place(pid, rec) for _, pid, rec in found[:limit]]
+
+def flush_place_index():
+    """把這次 invocation 新看到的店合併寫回 place_index（每格一次 merge set；過期紀錄順便刪掉）"""
+    with _place_index_lock:
+        pending = dict(_place_dirty)
+        _place_dirty.clear()
+        min_seen = int(time.time() * 1000) - PLACE_INDEX_MAX_AGE_SEC * 1000
+        for cell, recs in pending.items():
+            b = _place_cells.get(cell)
+            if b is None:
+                continue
+            for pid in [pid for pid, rec in b["places"].items() if rec.get("seenMs", 0) < min_seen]:
+                b["places"].pop(pid, None)
+                b["rows"] = None
+                recs[pid] = firestore.DELETE_FIELD
+    if not pending:
+        return
+    try:
+        db = get_db()
+        bw = db.bulk_writer()
+        for cell, recs in pending.items():
+            bw.set(db.collection(PLACE_INDEX_COLLECTION).document(cell),
+                   {"cell": cell, "places": recs, "updatedAt": firestore.SERVER_TIMESTAMP}, merge=True)
+        bw.close()
+        trace_count("fs.writes", len(pending))
+    except Exception as e:
+        print("PLACE_INDEX_EXC", {"n": len(pending), "err": repr(e)})
+
+# ── 排序（ranking）：整個候選池一次向量化計算 ────────────────────────────────
+# settings/ranking 可調：
+#   mode: "distance"（距離優先、再看評分；預設）| "score"（綜合分數）
+#   wDist / wRating / wPref: 綜合分數權重
+#   distScaleKm: 距離衰減尺度 exp(-d / scale)
+#   priorRating / priorCount: 評分的貝氏平滑（評論數少的店往平均值拉）
+RANKING_DEFAULTS: Dict[str, Any] = {
+    "mode": "distance",
+    "wDist": 0.6, "wRating": 0.3, "wPref": 0.1,
+    "distScaleKm": 0.6,
+    "priorRating": 3.8, "priorCount": 20,
+}
+
+def _ranking_config(overrides: dict | None = None) -> dict:
+    cfg = dict(RANKING_DEFAULTS)
+    try:
+        cfg.update({k: v for k, v in (get_settings().get("ranking") or {}).items() if k in RANKING_DEFAULTS})
+    except Exception:
+        pass
+    cfg.update(overrides or {})
+    return cfg
+
+def _numpy():
+    """numpy 為選配：沒裝就走逐筆計算"""
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+# 候選池小於這個數量時，numpy 建陣列的固定成本比逐筆算還貴，直接走逐筆版本
+RANK_NUMPY_MIN = int(os.environ.get("RANK_NUMPY_MIN", "64"))
+
+# 店家 → (food_norm 後的店名, 食物類別)：依 placeId 快取，同一家店不必每次排序都重跑比對器；
+# 食物字典（settings/foods）改版時由 food_matcher() 清空
+_place_cats = TTLCache(int(os.environ.get("PLACE_CATS_CACHE_MAX", "20000")), 6 * 3600)
+
+def _place_categories(items: list[dict]) -> list[tuple[str, frozenset]]:
+    keys = [(it.get("placeId") or it.get("place_id") or "", it.get("name") or "") for it in items]
+    out = _place_cats.get_many(keys)
+    for i, hit in enumerate(out):
+        if hit is None:
+            norm = food_norm(keys[i][1])
+            out[i] = hit = (norm, frozenset(food_terms(norm)))
+            _place_cats.set(keys[i], hit)
+    return out
+
+def _affinity_terms(prefs: dict | None, top: int) -> list[tuple[str, float]]:
+    """使用者常選的前 top 個偏好詞 [(key, 次數)]"""
+    return sorted(((k, float(v)) for k, v in (prefs or {}).items() if k and isinstance(v, (int, float)) and v > 0),
+                  key=lambda kv: kv[1], reverse=True)[:top]
+
+def _pref_affinity(items: list[dict], prefs: dict | None, top: int = 10) -> list[float]:
+    """店名含使用者常選的偏好詞 → 依次數占比給分（0~1）"""
+    terms = _affinity_terms(prefs, top)
+    if not terms:
+        return [0.0] * len(items)
+    total = sum(v for _, v in terms) or 1.0
+    return [sum(v for k, v in terms if k in name or k in cats) / total
+            for name, cats in _place_categories(items)]
+
+def _pref_affinity_np(np, items: list[dict], prefs: dict | None, top: int = 10):
+    """同 _pref_affinity：店家 × 偏好詞的 0/1 矩陣乘上權重向量，一次算完"""
+    terms = _affinity_terms(prefs, top)
+    if not terms:
+        return np.zeros(len(items))
+    keys = [k for k, _ in terms]
+    weights = np.array([v for _, v in terms], dtype=float)
+    member = np.array([[k in name or k in cats for k in keys]
+                       for name, cats in _place_categories(items)], dtype=float)
+    return member @ weights / (weights.sum() or 1.0)
+
+def _rank_vectorized(np, items: list[dict], lat: float, lng: float, prefs: dict | None, cfg: dict) -> list[dict]:
+    lats = np.array([it.get("lat") if isinstance(it.get("lat"), (int, float)) else np.nan for it in items], dtype=float)
+    lngs = np.array([it.get("lng") if isinstance(it.get("lng"), (int, float)) else np.nan for it in items], dtype=float)
+    rating = np.array([it.get("rating") if isinstance(it.get("rating"), (int, float)) else np.nan for it in items], dtype=float)
+    total = np.array([it.get("total") if isinstance(it.get("total"), (int, float)) else 0 for it in items], dtype=float)
+
+    # 距離（haversine，km）
+    rlat1, rlng1 = np.radians(lat), np.radians(lng)
+    rlat2, rlng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((rlat2 - rlat1) / 2) ** 2 + np.cos(rlat1) * np.cos(rlat2) * np.sin((rlng2 - rlng1) / 2) ** 2
+    dist = 6371.0 * 2 * np.arcsin(np.sqrt(a))
+    dist_round = np.round(dist, 2)
+    for it, d in zip(items, dist_round.tolist()):
+        it["distKm"] = None if d != d else d   # NaN → None
+
+    if cfg["mode"] == "score":
+        decay = np.nan_to_num(np.exp(-dist / max(1e-6, float(cfg["distScaleKm"]))), nan=0.0)
+        m, c = float(cfg["priorCount"]), float(cfg["priorRating"])
+        bayes = (total * np.nan_to_num(rating, nan=c) + m * c) / (total + m) / 5.0
+        aff = _pref_affinity_np(np, items, prefs)
+        score = float(cfg["wDist"]) * decay + float(cfg["wRating"]) * bayes + float(cfg["wPref"]) * aff
+        order = np.argsort(-score, kind="stable")
+    else:
+        order = np.lexsort((-np.nan_to_num(rating, nan=0.0), np.nan_to_num(dist_round, nan=1e9)))
+    return [items[i] for i in order.tolist()]
+
+def _rank_scalar(items: list[dict], lat: float, lng: float, prefs: dict | None, cfg: dict) -> list[dict]:
+    """沒有 numpy 時的逐筆版本（結果與向量化版相同）"""
+    for it in items:
+        ilat, ilng = it.get("lat"), it.get("lng")
+        it["distKm"] = (round(_haversine_km(lat, lng, float(ilat), float(ilng)), 2)
+                        if isinstance(ilat, (int, float)) and isinstance(ilng, (int, float)) else None)
+    if cfg["mode"] != "score":
+        return sorted(items, key=lambda x: (x["distKm"] if x["distKm"] is not None else 1e9,
+                                            -(x.get("rating") or 0)))
+    m, c = float(cfg["priorCount"]), float(cfg["priorRating"])
+    scale = max(1e-6, float(cfg["distScaleKm"]))
+    scores = []
+    for it, aff in zip(items, _pref_affinity(items, prefs)):
+        d = it["distKm"]
+        decay = exp(-d / scale) if d is not None else 0.0
+        v = float(it.get("total") or 0)
+        r = it.get("rating") if isinstance(it.get("rating"), (int, float)) else c
+        bayes = (v * r + m * c) / (v + m) / 5.0
+        scores.append(float(cfg["wDist"]) * decay + float(cfg["wRating"]) * bayes + float(cfg["wPref"]) * aff)
+    order = sorted(range(len(items)), key=lambda i: -scores[i])
+    return [items[i] for i in order]
+
+def rank_places(items: list[dict], lat: float, lng: float, prefs: dict | None = None,
+                config: dict | None = None) -> list[dict]:
+    """
+    對候選池排序並補上每筆的 distKm（公里，2 位小數）。
+    有 numpy 且候選池夠大（≥ RANK_NUMPY_MIN）時整池一次向量化計算，否則逐筆。config 可覆寫 settings/ranking。
+    """
+    if not items:
+        return []
+    cfg = _ranking_config(config)
+    np = _numpy() if len(items) >= RANK_NUMPY_MIN else None
+    if np is not None:
+        return _rank_vectorized(np, items, float(lat), float(lng), prefs, cfg)
+    return _rank_scalar(items, float(lat), float(lng), prefs, cfg)
+
+# ── 策略並行（投機波次） ───────────────────────────────────────────────────
+# PLACES_FANOUT_WAVE=1 為逐一呼叫（原行為）；>1 時每波同時送出數個策略，
+# 仍以優先序最前面的非空結果為準，其餘未開始的取消。
+PLACES_FANOUT_WAVE     = int(os.environ.get("PLACES_FANOUT_WAVE", "1"))
+# 成本護欄：每次搜尋最多允許幾個「可能用不到」的投機呼叫，用完就退回逐一呼叫
+PLACES_SPECULATIVE_MAX = int(os.environ.get("PLACES_SPECULATIVE_MAX", "4"))
+
+_places_pool: ThreadPoolExecutor | None = None
+
+def _places_executor() -> ThreadPoolExecutor:
+    global _places_pool
+    if _places_pool is None:
+        with _http_lock:
+            if _places_pool is None:
+                _places_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="places")
+    return _places_pool
+
+def _run_strategy(lat: float, lng: float, r: int, kind: str, p: dict) -> list[dict]:
+    """執行單一策略並轉成卡片結構；HTTP 錯誤視為無結果"""
+    try:
+        with span(f"places.{kind}"):
+            raw = place_index_lookup(lat, lng, r, kind, p, limit=30)   # 索引夠密就不打 Places
+            if raw is None and kind == "nearby":
+                raw = _nearby_once(lat, lng, r, p["types"], p["opennow"], limit=30, keyword=p.get("keyword"))
+            elif raw is None:
+                raw = _textsearch_once(lat, lng, r, p["query"], p["opennow"], limit=30)
+    except httpx.HTTPError:
+        return []
+    return [_transform_place_item(x, lat, lng, with_dist=False) for x in raw]
 
-def search_nearby_tiered(lat: float, lng: float, radii=(500, 800, 1200, 2000), limit=9, q: str | None = None):
+def search_nearby_tiered(lat: float, lng: float, radii=(500, 800, 1200, 2000), limit=9, q: str | None = None,
+                         wave: int | None = None, prefs: dict | None = None):
     """
     策略順序：
       A. nearby: type=restaurant, opennow
@@ -502,6 +1993,8 @@ def search_nearby_tiered(lat: float, lng: float, radii=(500, 800, 1200, 2000), l
       C. textsearch: query=餐廳|小吃|早午餐, opennow
       D. nearby: type=restaurant（不限制營業中）
     找到就依距離+評分排序，取前 N。
+    wave > 1（預設 PLACES_FANOUT_WAVE）時每波並行送出多個策略，仍取優先序最高的非空結果。
+    排序交給 rank_places（settings/ranking.mode），prefs 為使用者的偏好權重（UserContext.prefs）。
     """
     # 先建策略：若有 q，優先用 q，否則走通用策略
     if q:
@@ -521,265 +2014,1042 @@ def search_nearby_tiered(lat: float, lng: float, radii=(500, 800, 1200, 2000), l
             ("nearby",  {"types": "restaurant",               "opennow": False}),
         ]
 
+    # 優先序：半徑由小到大，同半徑內依策略順序
+    plan = [(r, kind, p) for r in radii for kind, p in strategies]
+    wave = max(1, int(wave or PLACES_FANOUT_WAVE))
+    budget = max(0, PLACES_SPECULATIVE_MAX)
+
     pool = []
     used_radius = radii[-1]
-    for r in radii:
-        for kind, p in strategies:
-            try:
-                raw = []
-                if kind == "nearby":
-                    raw = _nearby_once(lat, lng, r, p["types"], p["opennow"], limit=30, keyword=p.get("keyword"))
-                else:
-                    raw = _textsearch_once(lat, lng, r, p["query"], p["opennow"], limit=30)
-                items = [_transform_place_item(x, lat, lng) for x in raw]
-                pool.extend(items)
-                if pool:  # 有資料就停止擴半徑
-                    used_radius = r
-                    break
-            except httpx.HTTPError:
-                continue
-        if pool:
-            break
+    i = 0
+    while i < len(plan) and not pool:
+        n = 1 + min(wave - 1, budget)
+        step = plan[i:i + n]
+        budget -= len(step) - 1
+        i += len(step)
+
+        if len(step) == 1:
+            r, kind, p = step[0]
+            items = _run_strategy(lat, lng, r, kind, p)
+            if items:  # 有資料就停止擴半徑
+                pool, used_radius = items, r
+            continue
+
+        futs = [traced_submit(_places_executor(), _run_strategy, lat, lng, r, kind, p) for r, kind, p in step]
+        for (r, _, _), fut in zip(step, futs):
+            items = fut.result()
+            if items:
+                pool, used_radius = items, r
+                break
+        for fut in futs:
+            fut.cancel()  # 尚未開始的直接取消；已送出的跑完只會寫進快取
 
-    # 去重（以 placeId），排序（距離優先，再來評分），只留前 N
+    # 去重（以 placeId），排序，只留前 N
     seen, uniq = set(), []
     for it in pool:
         pid = it.get("placeId")
         if pid and pid not in seen:
             seen.add(pid)
             uniq.append(it)
-    uniq.sort(key=lambda x: (x.get("distKm") if x.get("distKm") is not None else 1e9,
-                             -(x.get("rating") or 0)))
-    return uniq[:limit], used_radius
+    usage_incr("searches.total")
+    if not uniq:
+        usage_incr("searches.empty")
+    trace_count("places.strategies", i)
+    with span("rank"):
+        ranked = rank_places(uniq, lat, lng, prefs=prefs)[:limit]
+    return ranked, used_radius
+
+# ── 圖片代理（/photo/p/{photo_reference}、/photo/d/{driveFileId}）：抓一次、縮圖、存 Storage ──
+# Flex 卡片的圖改用我們自己的網址（不含 API key）。網址帶 sig = HMAC(secret, "kind|ref|w")，
+# 沒簽章或簽章不對直接 403，不會替任意 photo_reference 花 Places Photo 額度。
+# 第一次被讀到時抓原圖、用 Pillow 縮到指定寬度（JPEG / PNG 以外一律轉 JPEG），
+# 存進 Storage photo_cache/{key}（Content-Type 依實際格式），之後由記憶體 LRU / Storage 回應；
+# 回應帶 public + s-maxage，經 Hosting rewrite 時由 CDN 快取，重複顯示不會打到 function。
+# Firestore photo_cache/{key} 記錄 createdMs / lastAccessMs，photoCacheEvict 每天清掉
+# 太久沒被讀（LRU）或存太久（age）的圖；CDN 快取期間讀不到 function，所以閒置門檻要比 s-maxage 長。
+PHOTO_PROXY_BASE      = os.environ.get("PHOTO_PROXY_BASE", "").rstrip("/")   # 例：https://YOUR_HOSTING_DOMAIN；未設定則沿用原本的圖片網址
+# 簽章金鑰：未設定時由 LINE channel secret 衍生（不必多一個 Secret Manager 項目）。
+# 函式層級的 secrets= 會取代全域清單，會產生卡片的 function（lineWorker / pushWorker / adminPush）都要列 LINE_CHANNEL_SECRET
+PHOTO_SIGNING_SECRET  = os.environ.get("PHOTO_SIGNING_SECRET", "")
+PHOTO_WIDTHS          = (400, 800, 1200)   # 只接受這幾種寬度，避免任意參數把快取打散
+PHOTO_MEM_MAX         = int(os.environ.get("PHOTO_MEM_MAX", "128"))
+PHOTO_MEM_TTL_SEC     = 3600
+PHOTO_CDN_MAX_AGE_SEC = int(os.environ.get("PHOTO_CDN_MAX_AGE_SEC", str(7 * 86400)))
+PHOTO_IDLE_DAYS       = float(os.environ.get("PHOTO_IDLE_DAYS", "30"))
+PHOTO_MAX_AGE_DAYS    = float(os.environ.get("PHOTO_MAX_AGE_DAYS", "180"))
+PHOTO_TOUCH_SEC       = 86400   # 同一張圖每個 instance 最多一天更新一次 lastAccessMs
+PHOTO_JPEG_QUALITY    = 82
+PHOTO_COLLECTION      = "photo_cache"
+PHOTO_PREFIX          = "photo_cache/"
+_PHOTO_REF_RE = re.compile(r"^[A-Za-z0-9_-]{10,1500}$")
+
+_photo_mem = TTLCache(PHOTO_MEM_MAX, PHOTO_MEM_TTL_SEC)   # key → (bytes, content-type)
+_photo_touched = TTLCache(4096, PHOTO_TOUCH_SEC)
+_photo_flight = SingleFlight()
+_bucket = None
+
+def get_bucket():
+    """預設 Storage bucket（google-cloud-storage 只有圖片代理用得到，第一次用時才載入）"""
+    global _bucket
+    if _bucket is None:
+        _admin_app()
+        from firebase_admin import storage
+        with _db_lock:
+            if _bucket is None:
+                _bucket = storage.bucket()
+    return _bucket
+
+def _photo_width(w) -> int:
+    try:
+        w = int(w)
+    except (TypeError, ValueError):
+        w = 800
+    return min(PHOTO_WIDTHS, key=lambda x: abs(x - w))
+
+def _photo_sig(kind: str, ref: str, width: int) -> str | None:
+    secret = PHOTO_SIGNING_SECRET or (LINE_SECRET and hmac.new(LINE_SECRET.encode(), b"photo-proxy", hashlib.sha256).hexdigest())
+    if not secret:
+        return None
+    return hmac.new(secret.encode(), f"{kind}|{ref}|{width}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def photo_proxy_url(kind: str, ref: str, width: int) -> str | None:
+    """kind: "p"（Places photo_reference）| "d"（Google Drive 檔案 ID）；未設定 PHOTO_PROXY_BASE 或沒有簽章金鑰時回 None"""
+    if not PHOTO_PROXY_BASE or not ref or not _PHOTO_REF_RE.match(ref):
+        return None
+    width = _photo_width(width)
+    sig = _photo_sig(kind, ref, width)
+    if not sig:
+        return None
+    return f"{PHOTO_PROXY_BASE}/photo/{kind}/{ref}?w={width}&sig={sig}"
+
+def _photo_key(kind: str, ref: str, width: int) -> str:
+    return hashlib.sha1(f"{kind}|{ref}|{width}".encode()).hexdigest()[:32]
+
+def _sniff_image_type(data: bytes) -> str | None:
+    """LINE 只吃 JPEG / PNG；其他格式回 None"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    return None
+
+def _fetch_photo_source(kind: str, ref: str, width: int) -> bytes:
+    if kind == "p":
+        r = http_request("places_photo", "GET", f"{PLACES_API_BASE}/maps/api/place/photo",
+                         params={"maxwidth": width, "photo_reference": ref, "key": PLACES_KEY},
+                         follow_redirects=True)
+        usage_incr(f"photos.places.{'OK' if r.status_code == 200 else f'HTTP_{r.status_code}'}")
+    else:
+        r = http_request("drive_thumbnail", "GET", "https://drive.google.com/thumbnail",
+                         params={"id": ref, "sz": f"w{width}"}, follow_redirects=True)
+    r.raise_for_status()
+    if not (r.headers.get("content-type") or "").startswith("image/"):
+        raise ValueError(f"not an image: {r.headers.get('content-type')}")
+    return r.content
+
+def _resize_photo(data: bytes, width: int) -> bytes:
+    """縮到 width 並轉成 JPEG；本來就夠小的 JPEG / PNG 原樣回傳（Pillow 列在 requirements.txt）"""
+    from PIL import Image
+    im = Image.open(io.BytesIO(data))
+    if im.width <= width and im.format in ("JPEG", "PNG"):
+        return data
+    im.thumbnail((width, width * 4))
+    out = io.BytesIO()
+    im.convert("RGB").save(out, "JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue()
+
+def _touch_photo(key: str):
+    if _photo_touched.get(key):
+        return
+    _photo_touched.set(key, True)
+    try:
+        get_db().collection(PHOTO_COLLECTION).document(key).set({"lastAccessMs": int(time.time() * 1000)}, merge=True)
+    except Exception as e:
+        print("PHOTO_TOUCH_EXC", repr(e))
+
+def load_photo(kind: str, ref: str, width: int) -> tuple[bytes, str]:
+    """記憶體 LRU → Storage → 來源（抓一次、縮圖、存 Storage 並登記）；回傳 (bytes, content-type)"""
+    key = _photo_key(kind, ref, width)
+    hit = _photo_mem.get(key)
+    if hit is not None:
+        trace_count("photo.memory")
+        return hit
+
+    blob = get_bucket().blob(f"{PHOTO_PREFIX}{key}")
+    try:
+        with span("photo.storage"):
+            data = blob.download_as_bytes()
+        usage_incr("photos.storage")
+        _touch_photo(key)
+    except NotFound:
+        with span("photo.fetch"):
+            data = _resize_photo(_fetch_photo_source(kind, ref, width), width)
+        if not _sniff_image_type(data):
+            raise ValueError("unsupported image format")
+        blob.cache_control = f"public, max-age={PHOTO_CDN_MAX_AGE_SEC}"
+        blob.upload_from_string(data, content_type=_sniff_image_type(data))
+        now_ms = int(time.time() * 1000)
+        get_db().collection(PHOTO_COLLECTION).document(key).set({
+            "kind": kind, "ref": ref, "width": width, "path": blob.name, "bytes": len(data),
+            "createdMs": now_ms, "lastAccessMs": now_ms,
+        })
+        _photo_touched.set(key, True)
+        usage_incr("photos.fetched")
+    hit = (data, _sniff_image_type(data) or "image/jpeg")
+    _photo_mem.set(key, hit)
+    return hit
+
+def evict_photo_cache(page: int = 300) -> int:
+    """刪掉閒置超過 PHOTO_IDLE_DAYS 或建立超過 PHOTO_MAX_AGE_DAYS 的圖（Storage 物件 + 登記文件）"""
+    db = get_db()
+    coll = db.collection(PHOTO_COLLECTION)
+    now_ms = int(time.time() * 1000)
+    cutoffs = (("lastAccessMs", now_ms - PHOTO_IDLE_DAYS * 86400 * 1000),
+               ("createdMs", now_ms - PHOTO_MAX_AGE_DAYS * 86400 * 1000))
+    total = 0
+    for field, cutoff in cutoffs:
+        while True:
+            snaps = coll.where(field, "<", int(cutoff)).limit(page).get()
+            if not snaps:
+                break
+            get_bucket().delete_blobs([(s.to_dict() or {}).get("path") or f"{PHOTO_PREFIX}{s.id}" for s in snaps],
+                                      on_error=lambda blob: None)   # 已不存在的物件略過
+            bw = db.bulk_writer()
+            for s in snaps:
+                bw.delete(s.reference)
+            bw.close()
+            total += len(snaps)
+            if len(snaps) < page:
+                break
+    return total
 
-# ── LINE Webhook ───────────────────────────────────────────────────────────
 @https_fn.on_request(region="asia-east1")
-def line(req: https_fn.Request) -> https_fn.Response:
-    # 讓 LINE 後台 Verify（GET）通過
-    if req.method != "POST":
-        return https_fn.Response("ok", status=200)
+def photo(req: https_fn.Request) -> https_fn.Response:
+    """GET /photo/{p|d}/{ref}?w=800&sig=… → 圖片 bytes（可被 CDN 快取）；簽章不對 403，抓圖失敗轉到預設圖"""
+    parts = [x for x in req.path.split("/") if x]
+    if parts and parts[0] == "photo":
+        parts = parts[1:]
+    if req.method not in ("GET", "HEAD") or len(parts) != 2 or parts[0] not in ("p", "d") \
+            or not _PHOTO_REF_RE.match(parts[1]):
+        return https_fn.Response("not found", status=404)
+    kind, ref = parts
+    width = _photo_width(req.args.get("w"))
+    sig = _photo_sig(kind, ref, width)
+    if not sig or not hmac.compare_digest(req.args.get("sig") or "", sig):
+        usage_incr("photos.forbidden")
+        flush_usage()
+        return https_fn.Response("forbidden", status=403)
 
-    raw = req.data
-    if not verify_signature(raw, req.headers.get("x-line-signature", "")):
-        return https_fn.Response("invalid signature", status=401)
+    try:
+        with trace_scope("request", fn="photo", source=kind):
+            (data, ctype), shared = _photo_flight.do(_photo_key(kind, ref, width),
+                                                      lambda: load_photo(kind, ref, width))
+            if shared:
+                usage_incr("photos.coalesced")
+                trace_count("photo.coalesced")
+    except Exception as e:
+        print("PHOTO_EXC", {"kind": kind, "width": width, "err": repr(e)})
+        return https_fn.Response("", status=302, headers={"Location": FLEX_DEFAULT_IMAGE,
+                                                          "Cache-Control": "public, max-age=300"})
+    finally:
+        flush_usage()
+    return https_fn.Response(data, status=200, headers={
+        "Content-Type": ctype,
+        "Cache-Control": f"public, max-age={PHOTO_CDN_MAX_AGE_SEC}, s-maxage={PHOTO_CDN_MAX_AGE_SEC}",
+    })
 
-    body = json.loads(raw.decode() or "{}")
-    events = body.get("events", [])
+@scheduler_fn.on_schedule(schedule="every day 04:00", region="asia-east1",
+                          timezone=scheduler_fn.Timezone("Asia/Taipei"))
+def photoCacheEvict(event: scheduler_fn.ScheduledEvent) -> None:
+    print("PHOTO_EVICT", {"deleted": evict_photo_cache()})
+
+# ── 重送去重（webhookEventId）：記憶體 LRU → Firestore 標記（create 不可覆寫） ────
+# LINE 在回應太慢 / 失敗時會重送（deliveryContext.isRedelivery=true，webhookEventId 不變）。
+# 每個事件先搶 webhook_events/{hash(webhookEventId)}：已存在就是重複，直接略過。
+# DEDUP_MODE：firestore（預設）| memory（只用單一 instance 的 LRU）| off
+DEDUP_MODE       = os.environ.get("DEDUP_MODE", "firestore")
+DEDUP_TTL_SEC    = int(os.environ.get("DEDUP_TTL_SEC", str(24 * 3600)))
+DEDUP_LRU_MAX    = int(os.environ.get("DEDUP_LRU_MAX", "4096"))
+DEDUP_COLLECTION = "webhook_events"
+
+_seen_events = TTLCache(DEDUP_LRU_MAX, DEDUP_TTL_SEC)
+
+def _dedup_ref(event_id: str):
+    # webhookEventId 是依時間遞增的 ULID，直接當文件 ID 會寫在同一段 key range 上
+    return get_db().collection(DEDUP_COLLECTION).document(hashlib.sha1(event_id.encode()).hexdigest()[:24])
+
+def claim_event(ev: dict) -> bool:
+    """第一次看到這個事件回 True（並留下標記）；重複回 False。Firestore 出錯時放行（寧可重做也不漏）"""
+    event_id = ev.get("webhookEventId")
+    if DEDUP_MODE == "off" or not event_id:
+        return True
+    redelivery = bool((ev.get("deliveryContext") or {}).get("isRedelivery"))
+    if redelivery:
+        usage_incr("webhook.redelivered")
+    if _seen_events.get(event_id):
+        usage_incr("webhook.duplicates")
+        trace_count("dedup.memory")
+        return False
+    _seen_events.set(event_id, True)
+    if DEDUP_MODE != "firestore":
+        return True
+    now = time.time()
+    try:
+        with span("dedup"):
+            _dedup_ref(event_id).create({
+                "eventId": event_id,
+                "redelivery": redelivery,
+                "at": firestore.SERVER_TIMESTAMP,
+                "expireAt": datetime.datetime.fromtimestamp(now + DEDUP_TTL_SEC, datetime.timezone.utc),
+            })
+        trace_count("fs.writes")
+        return True
+    except AlreadyExists:
+        usage_incr("webhook.duplicates")
+        trace_count("dedup.firestore")
+        return False
+    except Exception as e:
+        print("DEDUP_EXC", repr(e))
+        return True
 
-    for ev in events:
-        etype = ev.get("type")
-        uid = (ev.get("source") or {}).get("userId")
+def release_event(ev: dict):
+    """處理失敗時撤掉標記，讓 LINE 之後的重送還能再處理一次"""
+    event_id = ev.get("webhookEventId")
+    if DEDUP_MODE == "off" or not event_id:
+        return
+    _seen_events.pop(event_id)
+    if DEDUP_MODE == "firestore":
+        try:
+            _dedup_ref(event_id).delete()
+        except Exception as e:
+            print("DEDUP_EXC", repr(e))
 
-        if etype == "follow":
-            upsert_user(uid, source=ev.get("source"))
-            log_event(uid, "follow", ev)
+# ── LINE Webhook ───────────────────────────────────────────────────────────
+def handle_event(ev: dict):
+    """
+    處理單一 webhook 事件；重送的重複事件在讀任何資料前就略過。
+    users/{uid} 的讀取只做一次，事件狀態在處理完時一次寫入；過期的 LINE profile 之後另外寫一次。
+    """
+    if ev.get("type") not in ("follow", "postback", "message"):
+        return
+    with trace_scope("event", type=ev.get("type"), msgType=(ev.get("message") or {}).get("type"),
+                     webhookEventId=ev.get("webhookEventId")):
+        if not claim_event(ev):
+            trace_attr(duplicate=True)
+            return
+        try:
+            ctx = UserContext.load((ev.get("source") or {}).get("userId"))
             try:
-                tops = get_top_food_prefs(uid, k=5)
+                with span("dispatch"):
+                    _dispatch_event(ev, ctx)
+            finally:
+                ctx.flush()   # 對話狀態先寫入，不等 LINE profile
+        except BaseException:
+            release_event(ev)   # 狀態沒寫成功：讓重送可以再處理
+            raise
+        try:
+            with span("profile"):
+                refresh_profile(ctx)  # 已回覆、狀態也存好了才抓 profile
+        except Exception as e:
+            print("PROFILE_EXC", repr(e))
+
+def _dispatch_event(ev: dict, ctx: UserContext):
+    etype = ev.get("type")
+    uid = ctx.uid
+
+    if etype == "follow":
+        upsert_user(uid, source=ev.get("source"), ctx=ctx)
+        log_event(uid, "follow", ev)
+        try:
+            tops = ctx.top_food_prefs(k=5)
+            qr_items = [{"type":"action","action":{"type":"message","label":x,"text":x}} for x in tops][:5]
+            set_next(uid, "expect_food", ctx)
+            line_reply(ev["replyToken"], [{
+                "type":"text",
+                "text":"感謝加入！先輸入偏好食物（隨你慣用的寫法），再選搜尋半徑，最後分享你的位置 📍",
+                "quickReply": {"items": qr_items} if qr_items else None
+            }])
+        except Exception:
+            pass
+        return
+
+    if etype == "postback":
+        upsert_user(uid, source=ev.get("source"), ctx=ctx)
+        data = (ev.get("postback") or {}).get("data") or ""
+        if data.startswith("radius=") and uid:
+            try:
+                radius = int(data.split("=",1)[1])
+                set_user_radius(uid, radius, ctx)
+                save_user_message(uid, {"type":"postback", "data": data}, ctx)
+                log_event(uid, "postback", ev)
+                line_reply(ev["replyToken"], [{
+                    "type":"text",
+                    "text": f"已設定搜尋半徑為 {radius} 公尺，請分享你的位置 📍",
+                    "quickReply": {"items":[{"type":"action","action":{"type":"location","label":"分享位置 📍"}}]}
+                }])
+            except ValueError:
+                line_reply(ev["replyToken"], [{"type":"text","text":"半徑格式不正確，請重新選擇一次喔。"}])
+        return
+
+    if etype == "message":
+        upsert_user(uid, source=ev.get("source"), ctx=ctx)
+        msg = ev.get("message") or {}
+        mtype = msg.get("type")
+
+        # 記錄對話
+        content = {"type": mtype}
+        if mtype == "text":
+            content["text"] = (msg.get("text") or "")[:2000]
+        elif mtype == "location":
+            content.update({
+                "latitude": msg.get("latitude"),
+                "longitude": msg.get("longitude"),
+                "address": msg.get("address")
+            })
+        else:
+            content["raw"] = msg
+        if uid: save_user_message(uid, content, ctx)
+        log_event(uid, "message", ev)
+
+        # 關鍵字 → 距離選擇 + 分享位置
+        if mtype == "text":
+            text = (msg.get("text") or "").strip()
+
+            # ✅ 若系統關閉，一開始輸入啟動詞就直接回覆
+            if not is_maps_enabled() and text in ("現在吃什麼", "吃什麼", "我要吃什麼"):
+                line_reply(ev["replyToken"], [{
+                    "type": "text",
+                    "text": "目前餐廳查詢功能暫時關閉，請稍後再試 🙏"
+                }])
+                return
+
+            # 會話狀態：若正在收偏好，就把本次文字當偏好，記錄後引導選半徑
+            next_step = ctx.next_step
+            msg_txt_raw = text
+            msg_txt_norm = canon_food(msg_txt_raw)   # 整句是別名才換成 canonical，否則保留原文
+
+            # 半徑格式（避免 2000m 被當成偏好）
+            radius_match = re.match(r"^\s*(\d{2,5})\s*m\s*$", msg_txt_raw, flags=re.I)
+
+            if next_step == "expect_food" and not radius_match:
+                if msg_txt_norm:
+                    record_food_pref(uid, msg_txt_raw, ctx)   # 計數依句中食物類別
+                    set_session_pref(uid, msg_txt_norm, ctx)  # ← 記住這次偏好
+                set_next(uid, "expect_radius", ctx)
+                line_reply(ev["replyToken"], [{
+                    "type":"text",
+                    "text": f"已記錄偏好：{msg_txt_raw} ✅\n請輸入搜尋半徑（例如：2000m），或點選下方常用選項。",
+                    "quickReply": {
+                        "items": [
+                            {"type":"action","action":{"type":"message","label":"1000m","text":"1000m"}},
+                            {"type":"action","action":{"type":"message","label":"1500m","text":"1500m"}},
+                            {"type":"action","action":{"type":"message","label":"2000m","text":"2000m"}}
+                        ]
+                    }
+                }])
+                return
+
+            # 1) 啟動流程 → 只請他選半徑
+            if text in ("現在吃什麼", "吃什麼", "我要吃什麼"):
+                tops = ctx.top_food_prefs(k=5)
                 qr_items = [{"type":"action","action":{"type":"message","label":x,"text":x}} for x in tops][:5]
-                set_next(uid, "expect_food")
+                set_next(uid, "expect_food", ctx)
                 line_reply(ev["replyToken"], [{
                     "type":"text",
-                    "text":"感謝加入！先輸入偏好食物（隨你慣用的寫法），再選搜尋半徑，最後分享你的位置 📍",
+                    "text":"請先輸入偏好食物（例如：牛肉麵、拉麵、滷味、燒臘、咖哩飯…照你的習慣打）",
                     "quickReply": {"items": qr_items} if qr_items else None
                 }])
-            except Exception:
-                pass
-            continue
+                return
+
+            # 2) 要求擴大範圍 → 請他再分享位置
+            if text in ("擴大範圍", "再找看看"):
+                line_reply(ev["replyToken"], [{
+                    "type": "text",
+                    "text": "請再分享一次位置，我會用更大的範圍幫你找 🔍",
+                    "quickReply": {
+                        "items": [
+                            {"type": "action", "action": {"type": "location", "label": "分享位置 📍"}}
+                        ]
+                    }
+                }])
+                return  # 這個事件到此結束，避免後面又處理到
 
-        if etype == "postback":
-            upsert_user(uid, source=ev.get("source"))
-            data = (ev.get("postback") or {}).get("data") or ""
-            if data.startswith("radius=") and uid:
+            # 3) 文字直接輸入半徑（例如 2000m）→ 設定並要求分享位置
+            if radius_match:
                 try:
-                    radius = int(data.split("=",1)[1])
-                    set_user_radius(uid, radius)
-                    save_user_message(uid, {"type":"postback", "data": data})
-                    log_event(uid, "postback", ev)
+                    radius = int(radius_match.group(1))
+                    set_user_radius(uid, radius, ctx)
+                    set_next(uid, "expect_location", ctx)  # 可選：標記目前等待位置
                     line_reply(ev["replyToken"], [{
-                        "type":"text",
+                        "type": "text",
                         "text": f"已設定搜尋半徑為 {radius} 公尺，請分享你的位置 📍",
                         "quickReply": {"items":[{"type":"action","action":{"type":"location","label":"分享位置 📍"}}]}
                     }])
                 except ValueError:
-                    line_reply(ev["replyToken"], [{"type":"text","text":"半徑格式不正確，請重新選擇一次喔。"}])
-            continue
+                    line_reply(ev["replyToken"], [{"type":"text","text":"半徑格式不正確，請輸入像 2000m 這樣的格式。"}])
+                return
 
-        if etype == "message":
-            upsert_user(uid, source=ev.get("source"))
-            msg = ev.get("message") or {}
-            mtype = msg.get("type")
-
-            # 記錄對話
-            content = {"type": mtype}
-            if mtype == "text":
-                content["text"] = (msg.get("text") or "")[:2000]
-            elif mtype == "location":
-                content.update({
-                    "latitude": msg.get("latitude"),
-                    "longitude": msg.get("longitude"),
-                    "address": msg.get("address")
-                })
-            else:
-                content["raw"] = msg
-            if uid: save_user_message(uid, content)
-            log_event(uid, "message", ev)
+        # 位置 → Places
+        if mtype == "location":
+            # ✅ 先檢查後台一鍵關閉開關
+            if not is_maps_enabled():
+                line_reply(ev["replyToken"], [{
+                    "type": "text",
+                    "text": "目前餐廳查詢功能暫時關閉，請稍後再試 🙏"
+                }])
+                return
+            lat = msg.get("latitude"); lng = msg.get("longitude")
+            prefer = ctx.radius
 
-            # 關鍵字 → 距離選擇 + 分享位置
-            if mtype == "text":
-                text = (msg.get("text") or "").strip()
+            if not prefer:
+                line_reply(ev["replyToken"], [{
+                    "type": "text",
+                    "text": "還沒選搜尋半徑喔，先選一個距離再分享位置 📍",
+                    "quickReply": quick_reply_radius()
+                }])
+                return
 
-                # ✅ 若系統關閉，一開始輸入啟動詞就直接回覆
-                if not is_maps_enabled() and text in ("現在吃什麼", "吃什麼", "我要吃什麼"):
-                    line_reply(ev["replyToken"], [{
-                        "type": "text",
-                        "text": "目前餐廳查詢功能暫時關閉，請稍後再試 🙏"
-                    }])
-                    continue
+            items, used_radius = [], prefer
+            try:
+                N = cards_per_reply()
+                qpref = ctx.session_pref  # 可能為 None
+                with span("places"):
+                    items, used_radius = search_nearby_tiered(lat, lng, radii=(prefer,), limit=N, q=qpref,
+                                                              prefs=ctx.prefs)
+            except Exception as e:
+                print("PLACES_EXC", repr(e))
+                items = []
 
-                # 會話狀態：若正在收偏好，就把本次文字當偏好，記錄後引導選半徑
-                next_step = get_next(uid)
-                msg_txt_raw = text
-                msg_txt_norm = norm_food(msg_txt_raw)
+            if not items:
+                msg_txt = "這附近目前找不到有營業的餐廳😵，換個距離再找？"
+                if qpref:
+                    msg_txt = f"在這附近找不到「{qpref}」😵，換個距離再找？或換個關鍵字試試。"
+                line_reply(ev["replyToken"], [{"type":"text","text": msg_txt, "quickReply": quick_reply_radius()}])
+                set_session_pref(uid, None, ctx)
+                return
 
-                # 半徑格式（避免 2000m 被當成偏好）
-                radius_match = re.match(r"^\s*(\d{2,5})\s*m\s*$", msg_txt_raw, flags=re.I)
+            title = f"用 {used_radius} 公尺範圍找到這些：" if not qpref else f"用 {used_radius} 公尺找「{qpref}」："
 
-                if next_step == "expect_food" and not radius_match:
-                    if msg_txt_norm:
-                        record_food_pref(uid, msg_txt_norm)
-                        set_session_pref(uid, msg_txt_norm)  # ← 記住這次偏好
-                    set_next(uid, "expect_radius")
-                    line_reply(ev["replyToken"], [{
-                        "type":"text",
-                        "text": f"已記錄偏好：{msg_txt_raw} ✅\n請輸入搜尋半徑（例如：2000m），或點選下方常用選項。",
-                        "quickReply": {
-                            "items": [
-                                {"type":"action","action":{"type":"message","label":"1000m","text":"1000m"}},
-                                {"type":"action","action":{"type":"message","label":"1500m","text":"1500m"}},
-                                {"type":"action","action":{"type":"message","label":"2000m","text":"2000m"}}
-                            ]
-                        }
-                    }])
-                    continue
+            with span("flex"):
+                flex_contents = build_flex_carousel(items, lat, lng, LIFF_SLOT_URL)  # {"type":"carousel",...}
 
-                # 1) 啟動流程 → 只請他選半徑
-                if text in ("現在吃什麼", "吃什麼", "我要吃什麼"):
-                    tops = get_top_food_prefs(uid, k=5)
-                    qr_items = [{"type":"action","action":{"type":"message","label":x,"text":x}} for x in tops][:5]
-                    set_next(uid, "expect_food")
-                    line_reply(ev["replyToken"], [{
-                        "type":"text",
-                        "text":"請先輸入偏好食物（例如：牛肉麵、拉麵、滷味、燒臘、咖哩飯…照你的習慣打）",
-                        "quickReply": {"items": qr_items} if qr_items else None
-                    }])
-                    continue
+            ok = line_reply(ev["replyToken"], [
+                {"type": "text", "text": title},
+                {
+                    "type": "flex",
+                    "altText": (title[:380] + "（圖卡）"),  # altText 必填且 ≤ 400 字
+                    "contents": flex_contents
+                }
+            ])
+
+            if not ok:
+                # 不要再回覆第二次，只記錄需要降級回覆的資訊
+                print("FLEX_FALLBACK_NEEDED", {
+                    "first": items[0].get("name"),
+                    "mapUrl": items[0].get("mapUrl")
+                })
 
-                # 2) 要求擴大範圍 → 請他再分享位置
-                if text in ("擴大範圍", "再找看看"):
-                    line_reply(ev["replyToken"], [{
-                        "type": "text",
-                        "text": "請再分享一次位置，我會用更大的範圍幫你找 🔍",
-                        "quickReply": {
-                            "items": [
-                                {"type": "action", "action": {"type": "location", "label": "分享位置 📍"}}
-                            ]
-                        }
-                    }])
-                    continue  # 這個事件到此結束，避免後面又處理到
-
-                # 3) 文字直接輸入半徑（例如 2000m）→ 設定並要求分享位置
-                if radius_match:
-                    try:
-                        radius = int(radius_match.group(1))
-                        set_user_radius(uid, radius)
-                        set_next(uid, "expect_location")  # 可選：標記目前等待位置
-                        line_reply(ev["replyToken"], [{
-                            "type": "text",
-                            "text": f"已設定搜尋半徑為 {radius} 公尺，請分享你的位置 📍",
-                            "quickReply": {"items":[{"type":"action","action":{"type":"location","label":"分享位置 📍"}}]}
-                        }])
-                    except ValueError:
-                        line_reply(ev["replyToken"], [{"type":"text","text":"半徑格式不正確，請輸入像 2000m 這樣的格式。"}])
-                    continue
+            set_next(uid, None, ctx)
+            set_session_pref(uid, None, ctx)
 
-            # 位置 → Places
-            if mtype == "location":
-                # ✅ 先檢查後台一鍵關閉開關
-                if not is_maps_enabled():
-                    line_reply(ev["replyToken"], [{
-                        "type": "text",
-                        "text": "目前餐廳查詢功能暫時關閉，請稍後再試 🙏"
-                    }])
-                    continue
-                lat = msg.get("latitude"); lng = msg.get("longitude")
-                prefer = get_user_radius(uid) if uid else None
+            return
 
-                if not prefer:
-                    line_reply(ev["replyToken"], [{
-                        "type": "text",
-                        "text": "還沒選搜尋半徑喔，先選一個距離再分享位置 📍",
-                        "quickReply": quick_reply_radius()
-                    }])
-                    continue
+def process_events(events: list[dict], concurrency: int | None = None):
+    """
+    同一 userId 的事件依序處理（確保 session 狀態一致），
+    不同 userId 之間並行，最多同時 concurrency 組（預設 EVENT_CONCURRENCY）。
+    任一事件失敗：該使用者後續事件不再處理，其餘使用者照常跑完後再丟出第一個例外。
+    """
+    groups: dict[str, list[dict]] = {}
+    for i, ev in enumerate(events):
+        key = (ev.get("source") or {}).get("userId") or f"_anon{i}"
+        groups.setdefault(key, []).append(ev)
+
+    limit = max(1, int(concurrency or EVENT_CONCURRENCY))
+    if len(groups) <= 1 or limit == 1:
+        for ev in events:
+            handle_event(ev)
+        return
+
+    async def _run_all():
+        sem = asyncio.Semaphore(limit)
+
+        async def _run_group(evs: list[dict]):
+            async with sem:
+                for ev in evs:
+                    await asyncio.to_thread(handle_event, ev)
+
+        return await asyncio.gather(*(_run_group(evs) for evs in groups.values()),
+                                    return_exceptions=True)
+
+    errors = [r for r in asyncio.run(_run_all()) if isinstance(r, BaseException)]
+    for e in errors:
+        print("EVENT_EXC", repr(e))
+    if errors:
+        raise errors[0]
 
-                items, used_radius = [], prefer
-                try:
-                    N = cards_per_reply()
-                    qpref = get_session_pref(uid)  # 可能為 None
-                    items, used_radius = search_nearby_tiered(lat, lng, radii=(prefer,), limit=N, q=qpref)
-                except Exception as e:
-                    print("PLACES_EXC", repr(e))
-                    items = []
-
-                if not items:
-                    msg_txt = "這附近目前找不到有營業的餐廳😵，換個距離再找？"
-                    if qpref:
-                        msg_txt = f"在這附近找不到「{qpref}」😵，換個距離再找？或換個關鍵字試試。"
-                    line_reply(ev["replyToken"], [{"type":"text","text": msg_txt, "quickReply": quick_reply_radius()}])
-                    set_session_pref(uid, None)
-                    continue
+@https_fn.on_request(region="asia-east1")
+def line(req: https_fn.Request) -> https_fn.Response:
+    # 讓 LINE 後台 Verify（GET）通過
+    if req.method != "POST":
+        return https_fn.Response("ok", status=200)
 
-                title = f"用 {used_radius} 公尺範圍找到這些：" if not qpref else f"用 {used_radius} 公尺找「{qpref}」："
+    with trace_scope("request", fn="line"):
+        raw = req.data
+        with span("verify"):
+            ok = verify_signature(raw, req.headers.get("x-line-signature", ""))
+        if not ok:
+            trace_attr(status=401)
+            return https_fn.Response("invalid signature", status=401)
+
+        body = json.loads(raw.decode() or "{}")
+        events = body.get("events", [])
+        trace_attr(events=len(events), mode=WEBHOOK_MODE)
+
+        try:
+            # 佇列模式：寫進 webhook_inbox 就回 200；寫入失敗則照舊同步處理，不丟事件
+            if WEBHOOK_MODE == "queue" and events and enqueue_webhook(events):
+                return https_fn.Response("ok", status=200)
+            process_events(events)
+        finally:
+            with span("flush"):
+                flush_event_logs()
+                flush_usage()
+                flush_place_index()
 
-                flex_contents = build_flex_carousel(items, lat, lng, LIFF_SLOT_URL)  # {"type":"carousel",...}
+    return https_fn.Response("ok", status=200)
 
-                ok = line_reply(ev["replyToken"], [
-                    {"type": "text", "text": title},
-                    {
-                        "type": "flex",
-                        "altText": (title[:380] + "（圖卡）"),  # altText 必填且 ≤ 400 字
-                        "contents": flex_contents
-                    }
-                ])
+# ── Webhook 佇列模式（webhook_inbox/{id} + lineWorker） ──────────────────────
+# webhook_inbox/{id}：uid, events（該使用者在這次 webhook 的原始事件）,
+# status = queued → running → done | failed, receivedAtMs, seq, expireAt（給 Firestore TTL policy 清掉舊文件）
+# 已經回 200 給 LINE，失敗不能丟：inboxSweep 定期重跑 failed、以及卡在 running 超過 INBOX_STALE_SEC
+# （worker timeout / crash）的文件，最多 INBOX_MAX_ATTEMPTS 次，用完標成 dead 留待人工查看。
+WEBHOOK_INBOX_COLLECTION = "webhook_inbox"
+WEBHOOK_INBOX_TTL_DAYS   = int(os.environ.get("WEBHOOK_INBOX_TTL_DAYS", "3"))
+# replyToken 的有效時間由 LINE 決定（約 1 分鐘）；留一點餘裕，超過就改用 push
+REPLY_TOKEN_TTL_SEC      = float(os.environ.get("REPLY_TOKEN_TTL_SEC", "50"))
+INBOX_ORDER_WAIT_SEC     = float(os.environ.get("INBOX_ORDER_WAIT_SEC", "10"))
+INBOX_MAX_ATTEMPTS       = int(os.environ.get("INBOX_MAX_ATTEMPTS", "3"))
+INBOX_STALE_SEC          = 180   # lineWorker timeout_sec（120）+ 餘裕：running 超過這麼久一定已被中斷
+INBOX_SWEEP_MAX          = 20    # 每輪最多重跑幾筆
+INBOX_SWEEP_BUDGET_SEC   = 200   # inboxSweep timeout 300s：超過就不再開始新的一筆
+
+def enqueue_webhook(events: list[dict]) -> bool:
+    """
+    依 userId 分組，每位使用者一筆 inbox 文件（同一個 batch，一次 commit）；失敗回 False。
+    分開存是為了讓 worker 能以「同一使用者的上一筆」確保處理順序。
+    """
+    now, seq = time.time(), time.time_ns()
+    groups: dict[str, list[dict]] = {}
+    for ev in events:
+        groups.setdefault((ev.get("source") or {}).get("userId") or "", []).append(ev)
+    try:
+        db = get_db()
+        col = db.collection(WEBHOOK_INBOX_COLLECTION)
+        batch = db.batch()
+        for uid, evs in groups.items():
+            batch.set(col.document(), {
+                "uid": uid,
+                "events": evs,
+                "status": "queued",
+                "attempts": 0,
+                "receivedAt": firestore.SERVER_TIMESTAMP,
+                "receivedAtMs": int(now * 1000),
+                "seq": seq,   # 同一使用者的處理順序（ns，毫秒內連續進來的也分得出先後）
+                "expireAt": datetime.datetime.fromtimestamp(now + WEBHOOK_INBOX_TTL_DAYS * 86400,
+                                                            datetime.timezone.utc),
+            })
+        with span("inbox.write"):
+            batch.commit()
+        trace_count("fs.writes", len(groups))
+        return True
+    except Exception as e:
+        print("INBOX_EXC", repr(e))
+        return False
 
-                if not ok:
-                    # 不要再回覆第二次，只記錄需要降級回覆的資訊
-                    print("FLEX_FALLBACK_NEEDED", {
-                        "first": items[0].get("name"),
-                        "mapUrl": items[0].get("mapUrl")
-                    })
+def _wait_for_previous(uid: str, seq: int, doc_id: str):
+    """
+    同一使用者上一筆 inbox 還沒處理完就稍等（最多 INBOX_ORDER_WAIT_SEC），
+    避免兩個 worker 同時改同一個 session。只看緊鄰的上一筆：它自己也會等更早的。
+    """
+    if not uid:
+        return
+    query = (get_db().collection(WEBHOOK_INBOX_COLLECTION)
+             .where("uid", "==", uid).where("seq", "<=", seq)
+             .order_by("seq", direction=firestore.Query.DESCENDING).limit(3))
+    deadline = time.time() + INBOX_ORDER_WAIT_SEC
+    delay = 0.05
+    with span("inbox.order"):
+        while True:
+            # seq 相同（極少見）以文件 ID 決定先後，避免互相等待
+            snaps = query.get()
+            trace_count("fs.reads", max(1, len(snaps)))
+            prev = [d for d in snaps if ((d.to_dict() or {}).get("seq", 0), d.id) < (seq, doc_id)]
+            if not prev or (prev[0].to_dict() or {}).get("status") not in ("queued", "running"):
+                return
+            if time.time() > deadline:
+                print("INBOX_ORDER_TIMEOUT", {"doc": doc_id, "prev": prev[0].id})
+                return
+            time.sleep(delay)
+            delay = min(0.4, delay * 2)
+
+def _reply_deadlines(events: list[dict], received_ms: int) -> Dict[str, tuple[str, float]]:
+    """以事件時間（沒有就用收到時間）起算 REPLY_TOKEN_TTL_SEC 作為各 replyToken 的期限"""
+    out = {}
+    for ev in events:
+        token, uid = ev.get("replyToken"), (ev.get("source") or {}).get("userId")
+        if token and uid:
+            t0 = (ev.get("timestamp") or received_ms) / 1000
+            out[token] = (uid, t0 + REPLY_TOKEN_TTL_SEC)
+    return out
 
-                set_next(uid, None)
-                set_session_pref(uid, None)
+def process_inbox(doc_id: str, data: dict | None = None) -> str:
+    """
+    處理一筆 webhook_inbox 文件，回傳最後狀態。
+    trigger 可能重送同一份文件：只處理 status=queued 的，重複事件另由 webhookEventId 去重
+    （失敗的事件會釋放去重標記，重跑時只會再處理沒完成的）。
+    """
+    ref = get_db().collection(WEBHOOK_INBOX_COLLECTION).document(doc_id)
+    if data is None:
+        data = ref.get().to_dict() or {}
+    if data.get("status") != "queued":
+        return data.get("status") or "missing"
+    ref.update({"status": "running", "attempts": Increment(1), "startedAt": firestore.SERVER_TIMESTAMP})
+
+    events = data.get("events") or []
+    received_ms = int(data.get("receivedAtMs") or time.time() * 1000)
+    usage_incr("webhook.queued", len(events))   # 計在 worker，ack 路徑只寫 inbox 一次
+    token = _reply_fallback.set(_reply_deadlines(events, received_ms))
+    result = {"status": "done"}
+    try:
+        with trace_scope("inbox", inboxId=doc_id, events=len(events),
+                         queuedMs=int(time.time() * 1000) - received_ms):
+            _wait_for_previous(data.get("uid") or "", int(data.get("seq") or 0), doc_id)
+            process_events(events)
+    except Exception as e:
+        attempts = int(data.get("attempts") or 0) + 1
+        result = {"status": "failed" if attempts < INBOX_MAX_ATTEMPTS else "dead", "error": repr(e)[:500]}
+        print("INBOX_FAILED", {"doc": doc_id, "attempts": attempts, "err": repr(e)})
+    finally:
+        _reply_fallback.reset(token)
+        flush_event_logs()
+        flush_usage()
+        flush_place_index()
+    result.update({"finishedAt": firestore.SERVER_TIMESTAMP,
+                   "latencyMs": int(time.time() * 1000) - received_ms})
+    ref.update(result)
+    return result["status"]
+
+@firestore_fn.on_document_created(document="webhook_inbox/{docId}", region="asia-east1",
+                                  secrets=["LINE_CHANNEL_ACCESS_TOKEN", "LINE_CHANNEL_SECRET", "PLACES_API_KEY"],
+                                  timeout_sec=120)
+def lineWorker(event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None]) -> None:
+    """WEBHOOK_MODE=queue 時由 line() 寫入的事件在這裡處理（沿用同一套 handle_event）"""
+    data = event.data.to_dict() if event.data else None
+    process_inbox(event.params["docId"], data)
+
+def sweep_inbox(limit: int = INBOX_SWEEP_MAX) -> int:
+    """
+    重跑 failed 與卡在 running 太久的 inbox 文件（設回 queued 後直接在這裡處理，
+    lineWorker 只在建立時觸發）；重試次數用完的標成 dead。回傳重跑筆數。
+    """
+    col = get_db().collection(WEBHOOK_INBOX_COLLECTION)
+    stale = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=INBOX_STALE_SEC)
+    snaps = list(col.where("status", "==", "failed").limit(limit).get())
+    snaps += col.where("status", "==", "running").where("startedAt", "<", stale).limit(limit).get()
+    deadline = time.time() + INBOX_SWEEP_BUDGET_SEC
+    n = 0
+    for snap in sorted(snaps, key=lambda s: (s.to_dict() or {}).get("seq") or 0)[:limit]:
+        if time.time() > deadline:
+            break   # 剩下的下一輪再跑
+        d = snap.to_dict() or {}
+        if int(d.get("attempts") or 0) >= INBOX_MAX_ATTEMPTS:
+            snap.reference.update({"status": "dead"})
+            print("INBOX_DEAD", {"doc": snap.id, "attempts": d.get("attempts")})
+            continue
+        snap.reference.update({"status": "queued"})
+        print("INBOX_RETRY", {"doc": snap.id, "from": d.get("status"), "attempts": d.get("attempts")})
+        process_inbox(snap.id, {**d, "status": "queued"})
+        n += 1
+    return n
+
+@scheduler_fn.on_schedule(schedule="every 2 minutes", region="asia-east1",
+                          timezone=scheduler_fn.Timezone("Asia/Taipei"),
+                          secrets=["LINE_CHANNEL_ACCESS_TOKEN", "LINE_CHANNEL_SECRET", "PLACES_API_KEY"],
+                          timeout_sec=300)
+def inboxSweep(event: scheduler_fn.ScheduledEvent) -> None:
+    print("INBOX_SWEEP", {"retried": sweep_inbox()})
+
+# ── 推播引擎（push_jobs/{jobId} + batches 子集合：排程、並行、重試、可續傳） ─────
+# push_jobs/{jobId}：status = queued → running → done | partial（中斷時回到 queued 自動續跑）
+#   時間用完：run_push_job 自己設回 queued；被強制中止（timeout / crash）：pushSweep 看到 running 的
+#   startedAt 超過 PUSH_STALE_SEC 就設回 queued。續跑時送到一半的批次仍是 pending，同一 retryKey 重送 LINE 回 409。
+# push_jobs/{jobId}/batches/{NNNNN}：to[≤500], status = pending | sent | failed, attempts, retryKey
+PUSH_CHUNK        = 500                                            # LINE multicast 單次上限
+PUSH_CONCURRENCY  = int(os.environ.get("PUSH_CONCURRENCY", "4"))  # 同時送出的批次數
+PUSH_MAX_ATTEMPTS = int(os.environ.get("PUSH_MAX_ATTEMPTS", "5"))
+PUSH_WORKER_TIMEOUT_SEC = 540
+# 單一批次最壞情況：每次都等到 timeout，再加上每次退避（Retry-After 最多 5 秒）
+PUSH_BATCH_WORST_SEC = (PUSH_MAX_ATTEMPTS * HTTP_ENDPOINTS["line_multicast"]["timeout"]
+                        + (PUSH_MAX_ATTEMPTS - 1) * max(5.0, HTTP_RETRY_BACKOFF_SEC * 2 ** (PUSH_MAX_ATTEMPTS - 2)))
+# 超過這個時間就不再領新批次，交給下一輪續跑：已送出的批次最壞還要 PUSH_BATCH_WORST_SEC，另留 30 秒收尾
+PUSH_WORKER_BUDGET_SEC = max(60.0, PUSH_WORKER_TIMEOUT_SEC - PUSH_BATCH_WORST_SEC - 30)
+PUSH_STALE_SEC = PUSH_WORKER_TIMEOUT_SEC + 60   # running 超過這麼久，worker 一定已經不在了
+
+def _chunks(it: Iterable, n: int):
+    buf = []
+    for x in it:
+        buf.append(x)
+        if len(buf) >= n:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+def create_push_job(line_msg: dict, targets: Iterable[str], meta: dict | None = None) -> tuple[str, int, int]:
+    """
+    把 targets 依 500 一批串流寫入 push_jobs/{jobId}/batches，最後才建立 job 文件
+    （status=queued，觸發 pushWorker）。回傳 (jobId, 批數, 人數)。
+    """
+    db = get_db()
+    job_ref = db.collection("push_jobs").document()
+    n_batches = n_targets = 0
+    wb, n_writes = db.batch(), 0
+    for chunk in _chunks(targets, PUSH_CHUNK):
+        wb.set(job_ref.collection("batches").document(f"{n_batches:05d}"), {
+            "to": chunk, "status": "pending", "attempts": 0, "retryKey": str(uuid.uuid4()),
+        })
+        n_batches += 1
+        n_targets += len(chunk)
+        n_writes += 1
+        if n_writes >= 100:  # 每批約 18KB，100 筆一次 commit
+            wb.commit()
+            wb, n_writes = db.batch(), 0
+    if n_writes:
+        wb.commit()
+
+    job_ref.set({
+        "ts": int(time.time()),
+        "status": "queued" if n_batches else "done",
+        "message": line_msg,
+        "targets": n_targets,
+        "batches": n_batches,
+        "success": 0,
+        "fail": 0,
+        **(meta or {}),
+    })
+    return job_ref.id, n_batches, n_targets
+
+# ── 推播對象：segment 條件在伺服器端分頁查詢 users，不經過瀏覽器 ──────────────
+# segment 欄位（皆可省略，但至少要有一項；全體推播用 {"all": true}）：
+#   lastSeenDays: int        最近 N 天內互動過（lastSeenAt 範圍查詢）
+#   prefs: [str]             prefs_list（top-K 偏好）含任一（array-contains-any，最多 30 個）
+#   topK: int                必須搭配 prefs：只挑前 K 名偏好含其中之一的人（預設不限）
+#   radiusMin / radiusMax    pref.radius 範圍
+SEGMENT_PAGE_SIZE = 500
+
+def _segment_match(data: dict, segment: dict, prefs: list[str]) -> bool:
+    """Firestore 查詢做不到的條件（topK / radius）在這裡逐筆過濾"""
+    ctx = UserContext(None, data)
+    top_k = segment.get("topK")
+    if prefs and top_k:
+        if not set(ctx.top_food_prefs(int(top_k))) & set(prefs):
+            return False
+    radius = ctx.radius
+    if segment.get("radiusMin") is not None and (radius is None or radius < int(segment["radiusMin"])):
+        return False
+    if segment.get("radiusMax") is not None and (radius is None or radius > int(segment["radiusMax"])):
+        return False
+    return True
 
-                continue
+def segment_error(segment) -> str | None:
+    """
+    檢查 segment；不合格回傳錯誤碼。
+    至少要有一個真正會篩選的條件（topK 只是 prefs 的附加條件，單獨出現等於全體，不接受）；
+    數值條件用 is None 判斷，radiusMin = 0 也算有設定。
+    """
+    if not isinstance(segment, dict):
+        return "BAD_SEGMENT"
+    prefs = [x for x in (segment.get("prefs") or []) if str(x).strip()] if isinstance(segment.get("prefs"), list) else []
+    if segment.get("topK") is not None and not prefs:
+        return "TOPK_REQUIRES_PREFS"
+    if not (segment.get("all") is True or prefs
+            or any(segment.get(k) is not None for k in ("lastSeenDays", "radiusMin", "radiusMax"))):
+        return "BAD_SEGMENT"
+    return None
 
-    return https_fn.Response("ok", status=200)
+def iter_segment_uids(segment: dict, page_size: int = SEGMENT_PAGE_SIZE):
+    """依 segment 以游標分頁串流 users，逐一 yield 符合的 userId（不整包載入記憶體）"""
+    q = get_db().collection("users")
+    days = segment.get("lastSeenDays")
+    if days is not None:
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=float(days))
+        q = q.where("lastSeenAt", ">=", since)
+    prefs = list(dict.fromkeys(k for x in (segment.get("prefs") or []) for k in food_pref_keys(str(x))))[:30]
+    if prefs:
+        q = q.where("prefs_list", "array_contains_any", prefs)
+    q = q.select(["lastSeenAt", "foodPrefs", "prefs", "pref"]).limit(page_size)
+
+    last = None
+    while True:
+        page = (q.start_after(last) if last else q).get()
+        for snap in page:
+            if _segment_match(snap.to_dict() or {}, segment, prefs):
+                yield snap.id
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+def _send_push_batch(bsnap, line_msg: dict | RawJSON) -> bool:
+    """送出單一批次；429/5xx/連線錯誤退避重試。同一 retryKey 重送時 LINE 回 409 表示已送達。"""
+    b = bsnap.to_dict() or {}
+    attempts = int(b.get("attempts") or 0)
+    status, err = None, None
+    while attempts < PUSH_MAX_ATTEMPTS:
+        attempts += 1
+        try:
+            r = http_request(
+                "line_multicast", "POST",
+                f"{LINE_API_BASE}/v2/bot/message/multicast",
+                headers={
+                    "Authorization": f"Bearer {LINE_TOKEN}",
+                    "Content-Type": "application/json",
+                    "X-Line-Retry-Key": b.get("retryKey") or str(uuid.uuid4()),
+                },
+                content=json_bytes({"to": b.get("to") or [], "messages": [line_msg]}),
+            )
+            status, err = r.status_code, None
+            if r.status_code < 400 or r.status_code == 409:
+                bsnap.reference.update({"status": "sent", "attempts": attempts, "httpStatus": status,
+                                        "sentAt": firestore.SERVER_TIMESTAMP})
+                usage_incr("push.batchesSent")
+                usage_incr("push.targetsSent", len(b.get("to") or []))
+                return True
+            err = r.text[:500]
+            print("LINE_MULTICAST_ERR", r.status_code, err)
+            if r.status_code not in HTTP_RETRY_STATUS:
+                break
+            delay = _retry_delay(r, attempts - 1)
+        except httpx.HTTPError as e:
+            status, err = None, repr(e)
+            print("LINE_MULTICAST_EXC", err)
+            delay = _retry_delay(None, attempts - 1)
+        if attempts < PUSH_MAX_ATTEMPTS:
+            time.sleep(delay)
+    bsnap.reference.update({"status": "failed", "attempts": attempts, "httpStatus": status, "error": err})
+    usage_incr("push.batchesFailed")
+    return False
+
+def run_push_job(job_id: str, budget_sec: float = PUSH_WORKER_BUDGET_SEC) -> dict:
+    """
+    處理 push_jobs/{jobId} 內所有 pending 批次（最多 PUSH_CONCURRENCY 批同時送）。
+    時間用完還有剩：job 設回 queued，由下一次 pushWorker 接續。
+    """
+    job_ref = get_db().collection("push_jobs").document(job_id)
+    job = job_ref.get().to_dict() or {}
+    line_msg = job.get("message")
+    if not line_msg:
+        return job
+    line_msg = RawJSON(json_bytes(line_msg))   # 整個 job 只序列化一次，每批只加上 to
+    job_ref.update({"status": "running", "startedAt": firestore.SERVER_TIMESTAMP})
+
+    deadline = time.time() + budget_sec
+    query = job_ref.collection("batches").where("status", "==", "pending").order_by("__name__").limit(50)
+    unfinished = False
+    with ThreadPoolExecutor(max_workers=PUSH_CONCURRENCY, thread_name_prefix="push") as pool:
+        inflight, last = set(), None
+        while not unfinished:
+            page = (query.start_after(last) if last else query).get()
+            if not page:
+                break
+            for bsnap in page:
+                if time.time() > deadline:
+                    unfinished = True
+                    break
+                if len(inflight) >= PUSH_CONCURRENCY:
+                    _, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                inflight.add(pool.submit(_send_push_batch, bsnap, line_msg))
+            last = page[-1]
+        wait(inflight)
+    flush_usage()
+
+    # 依批次狀態重算（續跑多輪也不會重複計數）
+    sent = failed = 0
+    for b in job_ref.collection("batches").select(["status"]).stream():
+        st = (b.to_dict() or {}).get("status")
+        sent += st == "sent"
+        failed += st == "failed"
+    result = {
+        "success": sent,
+        "fail": failed,
+        "status": "queued" if unfinished else ("done" if not failed else "partial"),
+    }
+    if not unfinished:
+        result["finishedAt"] = firestore.SERVER_TIMESTAMP
+    job_ref.update(result)
+    return result
+
+def resume_push_job(job_id: str) -> bool:
+    """失敗的批次重設為 pending 並把 job 設回 queued；job 不存在回 False"""
+    job_ref = get_db().collection("push_jobs").document(job_id)
+    if not job_ref.get().exists:
+        return False
+    for bsnap in job_ref.collection("batches").where("status", "==", "failed").stream():
+        bsnap.reference.update({"status": "pending", "attempts": 0})
+    job_ref.update({"status": "queued"})
+    return True
 
-@https_fn.on_request(region="asia-east1", secrets=["LINE_CHANNEL_ACCESS_TOKEN"])
+@firestore_fn.on_document_written(document="push_jobs/{jobId}", region="asia-east1",
+                                  secrets=["LINE_CHANNEL_ACCESS_TOKEN", "LINE_CHANNEL_SECRET"],
+                                  timeout_sec=PUSH_WORKER_TIMEOUT_SEC)
+def pushWorker(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """push_jobs/{jobId} 變成 queued（新建或續跑）時開始送出"""
+    before = event.data.before.to_dict() if event.data.before else {}
+    after  = event.data.after.to_dict() if event.data.after else {}
+    if (after or {}).get("status") != "queued" or (before or {}).get("status") == "queued":
+        return
+    run_push_job(event.params["jobId"])
+
+def requeue_stale_push_jobs() -> int:
+    """running 但 startedAt 超過 PUSH_STALE_SEC 的 job（worker 被強制中止）設回 queued，觸發 pushWorker 續跑"""
+    stale = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=PUSH_STALE_SEC)
+    snaps = (get_db().collection("push_jobs")
+             .where("status", "==", "running").where("startedAt", "<", stale).limit(50).get())
+    for snap in snaps:
+        snap.reference.update({"status": "queued", "requeues": Increment(1)})
+        print("PUSH_JOB_REQUEUE", {"job": snap.id})
+    return len(snaps)
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes", region="asia-east1",
+                          timezone=scheduler_fn.Timezone("Asia/Taipei"))
+def pushSweep(event: scheduler_fn.ScheduledEvent) -> None:
+    requeue_stale_push_jobs()
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes", region="asia-east1",
+                          timezone=scheduler_fn.Timezone("Asia/Taipei"))
+def rollupUsage(event: scheduler_fn.ScheduledEvent) -> None:
+    """把今天（跨日後的第一輪也補昨天）的分片計數加總回 usage_maps_daily/{YYYYMMDD}"""
+    now = datetime.datetime.now(TW_TZ)
+    rollup_usage(usage_day(now))
+    if now.hour == 0 and now.minute < 10:
+        rollup_usage(usage_day(now - datetime.timedelta(days=1)))
+
+@https_fn.on_request(region="asia-east1", secrets=["LINE_CHANNEL_ACCESS_TOKEN", "LINE_CHANNEL_SECRET"])
 def adminPush(req: https_fn.Request) -> https_fn.Response:
     """後台『特定行銷』推播 API。
     請求格式：
       headers: Authorization: Bearer <Firebase ID Token>
       body: {
         "targets": ["<LINE userId>", ...],   // 由前端勾選
+        // 或 "segment": { "lastSeenDays": 30, "prefs": ["拉麵"], "topK": 5, "radiusMin": 500, "radiusMax": 2000 }
         "message": {
           "type": "text", "text": "可\n換行"
           // 或
           "type": "flex", "title": "...", "body": "...", "image": "https://...", "buttonLabel": "...", "buttonUrl": "https://..."
         }
       }
-    回應：{ ok, batches, success, fail } 或 { error }
+      或 body: { "resumeJobId": "<jobId>" }   // 續跑中斷的工作
+    回應：{ ok, jobId, batches, targets } 或 { error }（實際送出由 pushWorker 背景處理）
     """
     try:
         # 1) 權限驗證
@@ -790,9 +3060,25 @@ def adminPush(req: https_fn.Request) -> https_fn.Response:
                                      headers={"Content-Type": "application/json"})
 
         data = req.get_json(silent=True) or {}
+
+        # 續跑中斷 / 部分失敗的工作：pushWorker 會接著送 pending 批次
+        if data.get("resumeJobId"):
+            job_id = str(data["resumeJobId"])
+            if not resume_push_job(job_id):
+                return https_fn.Response(json.dumps({"error": "NO_SUCH_JOB"}), status=404,
+                                         headers={"Content-Type": "application/json"})
+            return https_fn.Response(json.dumps({"ok": True, "jobId": job_id}),
+                                     headers={"Content-Type": "application/json"})
+
         targets = data.get("targets") or []
+        segment = data.get("segment")
         msg     = data.get("message") or {}
-        if not isinstance(targets, list) or not targets:
+        if segment is not None:
+            err = segment_error(segment)
+            if err:
+                return https_fn.Response(json.dumps({"error": err}), status=400,
+                                         headers={"Content-Type": "application/json"})
+        elif not isinstance(targets, list) or not targets:
             return https_fn.Response(json.dumps({"error": "NO_TARGETS"}), status=400,
                                      headers={"Content-Type": "application/json"})
 
@@ -816,42 +3102,15 @@ def adminPush(req: https_fn.Request) -> https_fn.Response:
             return https_fn.Response(json.dumps({"error": "BAD_MESSAGE"}), status=400,
                                      headers={"Content-Type": "application/json"})
 
-        # 3) 依 LINE multicast 限制分批（500/批）
-        CHUNK = 500
-        batches = [targets[i:i+CHUNK] for i in range(0, len(targets), CHUNK)]
-        succ = fail = 0
-        for batch in batches:
-            try:
-                r = httpx.post(
-                    "https://api.line.me/v2/bot/message/multicast",
-                    headers={
-                        "Authorization": f"Bearer {LINE_TOKEN}",
-                        "Content-Type": "application/json",
-                    },
-                    json={"to": batch, "messages": [line_msg]},
-                    timeout=15.0,
-                )
-                if r.status_code < 400:
-                    succ += 1
-                else:
-                    fail += 1
-                    print("LINE_MULTICAST_ERR", r.status_code, r.text[:500])
-            except Exception as e:
-                fail += 1
-                print("LINE_MULTICAST_EXC", repr(e))
-
-        # 4) 記一筆 job
-        get_db().collection("push_jobs").add({
-            "ts": int(time.time()),
-            "type": msg.get("type"),
-            "targets": len(targets),
-            "batches": len(batches),
-            "success": succ,
-            "fail": fail,
-        })
+        # 3) 建立推播工作，實際送出交給 pushWorker（segment 邊查邊寫入批次）
+        if segment is not None:
+            job_id, n_batches, n_targets = create_push_job(
+                line_msg, iter_segment_uids(segment), {"type": msg.get("type"), "segment": segment})
+        else:
+            job_id, n_batches, n_targets = create_push_job(line_msg, targets, {"type": msg.get("type")})
 
         return https_fn.Response(json.dumps({
-            "ok": True, "batches": len(batches), "success": succ, "fail": fail
+            "ok": True, "jobId": job_id, "batches": n_batches, "targets": n_targets
         }), headers={"Content-Type": "application/json"})
 
     except PermissionError as e:
@@ -0,0 +1,40 @@
+"""
+圖片代理：拿不到簽章金鑰時（function 沒掛 LINE_CHANNEL_SECRET）卡片不能退回帶 Places key 的網址。
+
+用法（在 functions/ 下）：
+    python -m pytest -q tests
+"""
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+PLACE = {
+    "name": "拉麵 1號店",
+    "place_id": "pid1",
+    "geometry": {"location": {"lat": 22.997, "lng": 120.2127}},
+    "rating": 4.5,
+    "user_ratings_total": 120,
+    "vicinity": "台南市中西區",
+    "photos": [{"photo_reference": "A" * 40}],
+}
+
+def _card_bytes(monkeypatch, line_secret: str) -> bytes:
+    monkeypatch.setattr(main, "PHOTO_PROXY_BASE", "https://h.example")
+    monkeypatch.setattr(main, "PHOTO_SIGNING_SECRET", "")
+    monkeypatch.setattr(main, "LINE_SECRET", line_secret)
+    monkeypatch.setattr(main, "PLACES_KEY", "PLACES_SECRET_KEY")
+    main._store_settings({}, ttl_sec=10**9)   # 不讀 Firestore：settings 用預設值
+    main._flex_bubbles.clear()
+    item = main._transform_place_item(PLACE, 22.997, 120.2127)
+    return main.json_bytes(main.build_flex_carousel([item], 22.997, 120.2127))
+
+def test_card_without_signing_key_has_no_api_key(monkeypatch):
+    out = _card_bytes(monkeypatch, "")
+    assert b"key=" not in out
+    assert b"PLACES_SECRET_KEY" not in out
+
+def test_card_with_signing_key_uses_signed_proxy(monkeypatch):
+    out = _card_bytes(monkeypatch, "line-secret")
+    assert b"https://h.example/photo/p/" in out and b"sig=" in out
+    assert b"key=" not in out
@@ -18,6 +18,9 @@ const ui = {
   updatedAt:$("updatedAt"), btnReload:$("btnReload"), btnSave:$("btnSave"),
   btnDisable:$("btnDisable"), usageDate:$("usageDate"),
   uStatic:$("uStatic"), uEmbed:$("uEmbed"), uJs:$("uJs"), uTotal:$("uTotal"),
+  bPlaces:$("bPlaces"), bCache:$("bCache"), bIndex:$("bIndex"), bSearches:$("bSearches"), bEmpty:$("bEmpty"),
+  bReplies:$("bReplies"), bReplyFail:$("bReplyFail"), bPush:$("bPush"), rolledUpAt:$("rolledUpAt"),
+  bRedelivered:$("bRedelivered"), bDup:$("bDup"),
   cards:$("cards"), btnSaveReplies:$("btnSaveReplies"), statusReplies:$("statusReplies"),
 };
 
@@ -50,6 +53,18 @@ function bindLiveUsage(){
     const d=s.exists()?s.data():{};
     const a=d.requests_static||0, b=d.requests_embed||0, c=d.requests_js||0;
     ui.uStatic.textContent=a; ui.uEmbed.textContent=b; ui.uJs.textContent=c; ui.uTotal.textContent=a+b+c;
+
+    // 後端計數（places.{endpoint}.{status} 兩層加總）
+    const places=Object.values(d.places||{}).reduce((s,byStatus)=>s+Object.values(byStatus||{}).reduce((x,y)=>x+(y||0),0),0);
+    const cache=d.placesCache||{}, index=d.placeIndex||{}, searches=d.searches||{}, replies=d.replies||{}, push=d.push||{}, webhook=d.webhook||{};
+    ui.bPlaces.textContent=places;
+    ui.bCache.textContent=(cache.memory||0)+(cache.shared||0)+(cache.coalesced||0);
+    ui.bIndex.textContent=index.hit||0;
+    ui.bSearches.textContent=searches.total||0; ui.bEmpty.textContent=searches.empty||0;
+    ui.bReplies.textContent=replies.ok||0; ui.bReplyFail.textContent=replies.fail||0;
+    ui.bPush.textContent=push.targetsSent||0;
+    ui.bRedelivered.textContent=webhook.redelivered||0; ui.bDup.textContent=webhook.duplicates||0;
+    ui.rolledUpAt.textContent=d.rolledUpAt?`，最後彙整：${d.rolledUpAt.toDate().toLocaleString()}`:"";
   }, err=>console.error(err));
 }
 